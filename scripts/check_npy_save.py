@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Check that .npy data can be saved back over the file it was loaded from.
+
+load_file and load_4dstem memory-map .npy files, so the data (or a cropped,
+flipped or edited view of it) still reads from the source file while it is
+saved. Writing over that file in place truncates it under the mapping, which
+kills the process with SIGBUS and destroys the file.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+
+from TemCompanion.functions import (  # noqa: E402
+    copy_on_write,
+    load_4dstem,
+    load_file,
+    save_npy,
+)
+
+NPY = "Numpy Array Files (*.npy)"
+
+
+def check(name: str, ok: bool) -> bool:
+    print(f"{'ok' if ok else 'FAIL':4} {name}")
+    return ok
+
+
+def main() -> int:
+    rng = np.random.default_rng(0)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # 4D dataset, read-only map, saved as a flipped and cropped view
+        path = str(Path(tmp) / "data4d.npy")
+        original = rng.random((6, 7, 16, 16)).astype(np.float32)
+        np.save(path, original)
+        data = load_4dstem(path, NPY)["data"]
+        view = data[1:, ::-1, :, ::-1]
+        expected = np.array(view)
+        save_npy(path, view)
+        results.append(
+            check(
+                "4D view saved to its own file", np.array_equal(np.load(path), expected)
+            )
+        )
+        results.append(
+            check("4D source map still readable", np.array_equal(data, original))
+        )
+
+        # 4D dataset edited copy-on-write (remove_nan), saved to the same file
+        data = load_4dstem(path, NPY)["data"]
+        edited = copy_on_write(data)
+        edited[0, 0] = 0
+        expected = np.array(edited)
+        save_npy(path, edited)
+        results.append(
+            check("4D edited data saved", np.array_equal(np.load(path), expected))
+        )
+
+        # 2D image from load_file, copy-on-write map, saved without the suffix
+        path = str(Path(tmp) / "image.npy")
+        np.save(path, rng.random((32, 32)))
+        img = load_file(path, NPY)[0]["data"]
+        img *= 2
+        expected = np.array(img)
+        save_npy(path[: -len(".npy")], img)
+        results.append(
+            check(
+                "2D image saved to its own file",
+                np.array_equal(np.load(path), expected),
+            )
+        )
+
+        leftovers = [p.name for p in Path(tmp).iterdir() if ".tmp" in p.name]
+        results.append(check("no temporary files left", not leftovers))
+
+    if not all(results):
+        return 1
+    print("Saving over memory-mapped .npy files works.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
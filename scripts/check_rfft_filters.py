@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Check that the rfft2 path of the filters matches the full fft2 path.
+
+Real images go through rfft2/irfft2 with half-plane kernels, complex images
+still use the full fftshift(fft2) path. Feeding the same image as complex
+data gives the reference result, which must agree to floating point precision.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+
+from TemCompanion import filters  # noqa: E402
+
+# Even, odd and non-square (padded to square by the filters) inputs
+SHAPES = [(256, 256), (255, 255), (200, 256), (256, 183)]
+TOLERANCE = 1e-12
+
+
+def test_image(shape: tuple[int, int], seed: int = 0) -> np.ndarray:
+    # Lattice fringes plus noise, so the Wiener/ABS background has peaks to remove
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    lattice = np.cos(2 * np.pi * xx / 7.3) + np.cos(2 * np.pi * (xx + yy) / 11.1)
+    return lattice + 0.5 * rng.standard_normal(shape)
+
+
+def relative_error(result: np.ndarray, reference: np.ndarray) -> float:
+    return float(np.max(np.abs(result - reference)) / np.max(np.abs(reference)))
+
+
+def background_filter(img: np.ndarray, weight: str, **kwargs) -> np.ndarray:
+    # wiener_filter and abs_filter round their output to float32, compare the
+    # float64 result of the shared filter on the padded image instead
+    return filters._background_subtraction_filter(
+        filters.pad_to_square(img), weight, **kwargs
+    )
+
+
+CASES = {
+    "bw_lowpass": lambda img: filters.bw_lowpass(img, 4, 0.3),
+    "gaussian_lowpass": lambda img: filters.gaussian_lowpass(img, 0.3),
+    "gaussian_lowpass (highpass)": lambda img: filters.gaussian_lowpass(
+        img, 0.3, hp_cutoff_ratio=0.02
+    ),
+    "wiener_filter": lambda img: background_filter(img, "wiener"),
+    "wiener_filter (no lowpass)": lambda img: background_filter(
+        img, "wiener", lowpass=False
+    ),
+    "abs_filter": lambda img: background_filter(img, "abs"),
+    "get_avg_background": lambda img: filters.get_avg_background(
+        filters.pad_to_square(img)
+    ),
+}
+
+
+def main() -> int:
+    failed = 0
+    for shape in SHAPES:
+        img = test_image(shape)
+        for name, run in CASES.items():
+            result = run(img)
+            reference = np.real(run(img.astype(np.complex128)))
+            error = relative_error(result, reference)
+            status = "ok" if error <= TOLERANCE else "FAIL"
+            failed += status == "FAIL"
+            print(f"{status:4} {name:28} {str(shape):11} rel. error {error:.1e}")
+
+    if failed:
+        print(f"{failed} case(s) differ by more than {TOLERANCE:g}.")
+        return 1
+    print("The rfft2 and fft2 paths agree.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
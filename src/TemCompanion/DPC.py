@@ -1,54 +1,168 @@
+from functools import lru_cache
+
 import numpy as np
-from scipy.fft import fft2, fftshift, ifft2, fftfreq
-from .filters import gaussian_lowpass, pad_to_square
+from scipy.fft import rfft2, irfft2, ifftshift, fftfreq
+from .filters import get_filter_kernel
 
 
 # Integrate DPC function
-def reconstruct_iDPC(DPCx, DPCy, rotation=0, cutoff=0.02):
+def reconstruct_iDPC(DPCx, DPCy, rotation=0, cutoff=0.02, dtype=np.float64, workers=-1):
     """
     Reconstruct iDPC image from DPCx and DPCy images
-    DPCx, DPCy: arrays of the same size
+    DPCx, DPCy: arrays of the same size, 2D images or stacks of images
     rotation: float, scan rotation offset for the setup in degrees
     cutoff: float, cutoff for the high pass filter
+    dtype: output type, np.float64 or np.float32. float32 also computes in
+        single precision.
+    workers: number of threads for the FFTs, -1 uses all CPU cores
     ref: Ivan Lazić, et al. Ultramicroscopy 160 (2016) 265–280.
     """
-    if DPCx.ndim == 2:
-        im_y, im_x = DPCx.shape
-        if im_x != im_y:
-            DPCx = pad_to_square(DPCx)
-            DPCy = pad_to_square(DPCy)
-        # Rotate the DPC vector images
-        if rotation != 0:
-            ang = rotation * np.pi / 180  # Convert to radian
-            DPCx, DPCy = rotate_vector(DPCx, DPCy, ang)
+    reconstructor = get_idpc_reconstructor(DPCx.shape[-2:], cutoff)
+    return reconstructor(DPCx, DPCy, rotation, dtype=dtype, workers=workers)
+
+
+class IDPCReconstructor:
+    """
+    Reconstruct iDPC images of a fixed size. The inverse Laplacian and the
+    Gaussian high pass are computed once in the rfft2 layout and applied to
+    every frame, e.g. for image stacks and rotation searches.
+    shape: (im_y, im_x) of the DPC images, padded to square internally
+    cutoff: float, cutoff for the high pass filter, no high pass outside (0, 1]
+    ref: Ivan Lazić, et al. Ultramicroscopy 160 (2016) 265–280.
+    """
+
+    def __init__(self, shape, cutoff=0.02):
+        self.shape = tuple(int(i) for i in shape)
+        self.cutoff = cutoff
+        n = max(self.shape)
+        self.n = n
         # Make the k grid
-        qx, qy = fftfreq(DPCx.shape[1]), fftfreq(DPCx.shape[0])
+        qx, qy = fftfreq(n), fftfreq(n)
         kx, ky = np.meshgrid(qx, qy)
-        d1 = kx * fft2(DPCx) + ky * fft2(DPCy)
-        k2 = kx**2 + ky**2
-        d2 = 2 * np.pi * k2 * 1j
+        op_x, op_y = self.kernels(kx, ky)
+        if cutoff is not None and cutoff > 0 and cutoff <= 1:
+            # Gaussian high pass filter
+            hp = ifftshift(
+                get_filter_kernel(
+                    (n, n), "gaussian", cutoff_ratio=1, hp_cutoff_ratio=cutoff
+                )
+            )
+            op_x, op_y = op_x * hp, op_y * hp
+        self.op_x = _hermitian_half(op_x)
+        self.op_y = _hermitian_half(op_y)
+        self._single = None
+
+    def kernels(self, kx, ky):
+        # Inverse Laplacian applied to the gradient (DPCx, DPCy)
+        d2 = 2 * np.pi * (kx**2 + ky**2) * 1j
         d2[0, 0] = np.inf
-        iDPC_fft = d1 / d2
-        iDPC_fftshift = fftshift(iDPC_fft)
+        inv_d2 = 1 / d2
+        return kx * inv_d2, ky * inv_d2
+
+    def __call__(self, DPCx, DPCy, rotation=0, dtype=np.float64, workers=-1, chunk=16):
+        """
+        Reconstruct a 2D image or a stack of any number of leading axes.
+        Stacks are transformed in batches of chunk frames along the last two
+        axes, the frames in a batch are spread over the FFT worker threads.
+        """
+        if DPCx.ndim == 2:
+            DPCx, DPCy = DPCx.astype(dtype, copy=False), DPCy.astype(dtype, copy=False)
+            return self.to_image(self.spectrum(DPCx, DPCy, rotation, workers), workers)
 
-        # Apply a Gaussian high pass filter
-        if cutoff > 0 and cutoff <= 1:
-            iDPC = gaussian_lowpass(
-                iDPC_fftshift, cutoff_ratio=1, hp_cutoff_ratio=cutoff, space="fourier"
+        # Calculate on an image stack
+        stack_shape = DPCx.shape
+        DPCx = DPCx.reshape((-1,) + stack_shape[-2:])
+        DPCy = DPCy.reshape((-1,) + stack_shape[-2:])
+        iDPC = np.empty(DPCx.shape, dtype=dtype)
+        for start in range(0, DPCx.shape[0], chunk):
+            frames = slice(start, start + chunk)
+            f = self.spectrum(
+                DPCx[frames].astype(dtype, copy=False),
+                DPCy[frames].astype(dtype, copy=False),
+                rotation,
+                workers,
             )
-        else:
-            iDPC = np.real(ifft2(fftshift(iDPC_fftshift)))
+            iDPC[frames] = self.to_image(f, workers)
+        return iDPC.reshape(stack_shape)
 
-        iDPC = iDPC[:im_y, :im_x]  # Crop back to original size if padded
+    def ops(self, dtype):
+        # Kernels with the precision of the input, so float32 stays in complex64
+        if dtype == np.float32:
+            if self._single is None:
+                self._single = (
+                    self.op_x.astype(np.complex64),
+                    self.op_y.astype(np.complex64),
+                )
+            return self._single
+        return self.op_x, self.op_y
 
-    elif DPCx.ndim == 3:
-        # Calculate on an image stack
-        im_z = DPCx.shape[0]
-        iDPC = np.zeros(DPCx.shape)
-        for i in range(im_z):
-            iDPC[i, :, :] = reconstruct_iDPC(DPCx[i], DPCy[i], rotation, cutoff)
-    # iDPC_int16 = iDPC.astype('int16')
-    return iDPC
+    def rfft(self, img, workers=None):
+        # rfft2 over the last two axes, zero padded to square at the bottom and right
+        return rfft2(img, s=(self.n, self.n), axes=(-2, -1), workers=workers)
+
+    def spectrum(self, DPCx, DPCy, rotation=0, workers=None):
+        """rfft2 spectrum of the iDPC image(s)"""
+        # Rotate the DPC vector images
+        if rotation != 0:
+            ang = rotation * np.pi / 180  # Convert to radian
+            DPCx, DPCy = rotate_vector(DPCx, DPCy, ang)
+        op_x, op_y = self.ops(DPCx.dtype)
+        return self.rfft(DPCx, workers) * op_x + self.rfft(DPCy, workers) * op_y
+
+    def rotation_spectra(self, DPCx, DPCy, workers=None):
+        """
+        rfft2 spectra U and V of the iDPC images at 0 and 90 degrees rotation,
+        the iDPC image at any angle is cos(ang) U + sin(ang) V
+        """
+        op_x, op_y = self.ops(DPCx.dtype)
+        Fx, Fy = self.rfft(DPCx, workers), self.rfft(DPCy, workers)
+        return Fx * op_x + Fy * op_y, Fx * op_y - Fy * op_x
+
+    def to_image(self, spectrum, workers=None):
+        """iDPC image(s) from the rfft2 spectrum, cropped back to the original size"""
+        im_y, im_x = self.shape
+        img = irfft2(spectrum, s=(self.n, self.n), axes=(-2, -1), workers=workers)
+        return img[..., :im_y, :im_x]
+
+
+class DDPCReconstructor(IDPCReconstructor):
+    """
+    Spectral dDPC of a fixed image size. The divergence d/dx DPCx + d/dy DPCy
+    is taken as 2 pi i (kx FFT(DPCx) + ky FFT(DPCy)) together with the high
+    pass, so a frame needs only one rfft2/irfft2 pair.
+    shape: (im_y, im_x) of the DPC images, padded to square internally
+    cutoff: float, cutoff for the high pass filter, None for no filter
+    """
+
+    def kernels(self, kx, ky):
+        return 2j * np.pi * kx, 2j * np.pi * ky
+
+
+@lru_cache(maxsize=4)
+def _reconstructor(cls, shape, cutoff):
+    return cls(shape, cutoff)
+
+
+def get_idpc_reconstructor(shape, cutoff=0.02):
+    """Get a (cached) IDPCReconstructor for the image shape and cutoff"""
+    return _reconstructor(
+        IDPCReconstructor, tuple(int(i) for i in shape), float(cutoff)
+    )
+
+
+def get_ddpc_reconstructor(shape, cutoff=None):
+    """Get a (cached) DDPCReconstructor for the image shape and cutoff"""
+    if cutoff is not None:
+        cutoff = float(cutoff)
+    return _reconstructor(DDPCReconstructor, tuple(int(i) for i in shape), cutoff)
+
+
+def _hermitian_half(op):
+    # Half plane (rfft2 layout) of the Hermitian part (op(k) + op*(-k)) / 2, so that
+    # irfft2(op * rfft2(x)) equals ifft2(op * fft2(x)).real for real x
+    flipped = np.roll(op[::-1, ::-1], 1, axis=(0, 1))
+    op = (op + np.conj(flipped)) / 2
+    return np.ascontiguousarray(op[:, : op.shape[1] // 2 + 1])
 
 
 # def gaussian_high_pass(shape, cutoff=0.02):
@@ -64,34 +178,79 @@ def reconstruct_iDPC(DPCx, DPCy, rotation=0, cutoff=0.02):
 
 
 # Calculate the divergence
-def reconstruct_dDPC(DPCx, DPCy, rotation=0, cutoff=None, inverse=False):
-    if DPCx.ndim == 2:
-        # Rotate the DPC vector images
-        if rotation != 0:
-            ang = rotation * np.pi / 180  # Convert to radian
-            DPCx, DPCy = rotate_vector(DPCx, DPCy, ang)
-        dDPCx = np.gradient(DPCx, axis=1)
-        dDPCy = np.gradient(DPCy, axis=0)
-        dDPC = dDPCx + dDPCy
-        if cutoff is not None and cutoff > 0 and cutoff < 1:
-            dDPC = gaussian_lowpass(dDPC, cutoff_ratio=1, hp_cutoff_ratio=cutoff)
-        if inverse:
-            dDPC = -dDPC
-
-        # dDPC -= np.min(dDPC)
-    elif DPCx.ndim == 3:
-        im_z = DPCx.shape[0]
-        dDPC = np.zeros(DPCx.shape)
-        for i in range(im_z):
-            dDPC[i, :, :] = reconstruct_dDPC(DPCx[i], DPCy[i], rotation, inverse)
+def reconstruct_dDPC(
+    DPCx,
+    DPCy,
+    rotation=0,
+    cutoff=None,
+    inverse=False,
+    dtype=np.float64,
+    workers=-1,
+    method="gradient",
+):
+    """
+    Reconstruct dDPC (divergence) image from DPCx and DPCy images
+    DPCx, DPCy: arrays of the same size, 2D images or stacks of images
+    rotation: float, scan rotation offset for the setup in degrees
+    cutoff: float, cutoff for the Gaussian high pass filter, None for no filter
+    inverse: invert the contrast
+    dtype: output type, np.float64 or np.float32
+    workers: number of threads for the FFTs of the high pass filter
+    method: 'gradient' for finite differences (np.gradient),
+        'spectral' for Fourier derivatives applied with the high pass in a
+        single FFT pair. The spectral derivative is exact for band limited
+        signals but assumes periodic images, so it rings at the edges.
+    """
+    if method == "spectral":
+        reconstructor = get_ddpc_reconstructor(DPCx.shape[-2:], cutoff)
+        dDPC = reconstructor(DPCx, DPCy, rotation, dtype=dtype, workers=workers)
+        return -dDPC if inverse else dDPC
+    elif method != "gradient":
+        raise ValueError(f"Unknown dDPC method: {method}")
+
+    DPCx = DPCx.astype(dtype, copy=False)
+    DPCy = DPCy.astype(dtype, copy=False)
+    # Rotate the DPC vector images
+    if rotation != 0:
+        ang = rotation * np.pi / 180  # Convert to radian
+        DPCx, DPCy = rotate_vector(DPCx, DPCy, ang)
+    # The last two axes are the image for both single images and stacks
+    dDPCx = np.gradient(DPCx, axis=-1)
+    dDPCy = np.gradient(DPCy, axis=-2)
+    dDPC = dDPCx + dDPCy
+    if cutoff is not None and cutoff > 0 and cutoff < 1:
+        dDPC = gaussian_highpass(dDPC, cutoff, workers)
+    if inverse:
+        dDPC = -dDPC
+
+    # dDPC -= np.min(dDPC)
     # dDPC_int16 = dDPC.astype('int16')
     return dDPC
 
 
-def find_rotation_ang_max_contrast(DPCx, DPCy, step=1):
+def gaussian_highpass(img, cutoff, workers=-1):
+    """
+    Gaussian high pass filter over the last two axes, same as
+    filters.gaussian_lowpass(img, 1, hp_cutoff_ratio=cutoff) on each frame
+    img: real 2D image or stack of images
+    cutoff: float, high pass cutoff ratio
+    workers: number of threads for the FFTs
+    """
+    im_y, im_x = img.shape[-2:]
+    n = max(im_y, im_x)
+    kernel = get_filter_kernel(
+        (n, n), "gaussian", cutoff_ratio=1, hp_cutoff_ratio=cutoff, half=True
+    ).astype(img.dtype, copy=False)
+    f = rfft2(img, s=(n, n), axes=(-2, -1), workers=workers) * kernel
+    return irfft2(f, s=(n, n), axes=(-2, -1), workers=workers)[..., :im_y, :im_x]
+
+
+def find_rotation_ang_max_contrast(DPCx, DPCy, step=1, precision=None):
     """Try to find the scan rotation offset of DPC signals by maximizing the contrast
     DPCx, DPCy: 2d array of the same size
     step: invertal of degrees when evaluating the contrast in 0-360 degrees
+    precision: optional, refine the angles coarse-to-fine down to this interval
+        in degrees, e.g. 0.01
     Return: angle"""
     im_size = 256
     if DPCx.shape[0] > im_size and DPCx.shape[1] > im_size:
@@ -100,38 +259,105 @@ def find_rotation_ang_max_contrast(DPCx, DPCy, step=1):
         y0 = (DPCx.shape[0] - im_size) // 2
         DPCx = DPCx[y0 : y0 + im_size, x0 : x0 + im_size]
         DPCy = DPCy[y0 : y0 + im_size, x0 : x0 + im_size]
+    terms = idpc_rotation_variance(DPCx, DPCy)
     angles1 = np.arange(0, 180, step)
     angles2 = np.arange(-180, 0, step)
-    contrast = []
-    for ang in angles1:
-        iDPC = reconstruct_iDPC(DPCx, DPCy, ang)
-        contrast.append(np.std(iDPC))
+    ang1 = angles1[np.argmax(idpc_rotation_contrast(terms, angles1))]
+    ang2 = angles2[np.argmax(idpc_rotation_contrast(terms, angles2))]
+    if precision is not None:
+        # The contrast repeats every 180 degrees, so wrap back into the ranges
+        ang1 = _refine_max_contrast(terms, ang1, step, precision) % 180
+        ang2 = _refine_max_contrast(terms, ang2, step, precision) % 180 - 180
+    return ang1, ang2
+
+
+def idpc_rotation_variance(DPCx, DPCy, cutoff=0.02):
+    """
+    Variance terms of the iDPC image as a function of the scan rotation.
+    Rotation is linear in DPCx and DPCy, so iDPC(ang) = cos(ang) U + sin(ang) V
+    with U and V the iDPC images at 0 and 90 degrees, and
+    var(iDPC(ang)) = cos^2 var(U) + sin^2 var(V) + 2 sin cos cov(U, V).
+    The terms are computed from two real FFTs and Parseval's theorem.
+    DPCx, DPCy: 2d array of the same size
+    cutoff: float, cutoff for the high pass filter as in reconstruct_iDPC
+    Return: var(U), var(V), cov(U, V)
+    """
+    im_y, im_x = DPCx.shape
+    reconstructor = get_idpc_reconstructor((im_y, im_x), cutoff)
+    U, V = reconstructor.rotation_spectra(DPCx, DPCy)
 
-    i_max1 = contrast.index(max(contrast))
-    contrast = []
-    for ang in angles2:
-        iDPC = reconstruct_iDPC(DPCx, DPCy, ang)
-        contrast.append(np.std(iDPC))
-    i_max2 = contrast.index(max(contrast))
-    return angles1[i_max1], angles2[i_max2]
+    if im_x != im_y:
+        # The padding is cropped away, so Parseval does not apply
+        u = reconstructor.to_image(U)
+        v = reconstructor.to_image(V)
+        u, v = u - u.mean(), v - v.mean()
+        return np.mean(u**2), np.mean(v**2), np.mean(u * v)
 
+    # The half plane holds the columns 1 to n/2 - 1 twice in the full spectrum
+    n = reconstructor.n
+    w = np.full(U.shape[1], 2.0)
+    w[0] = 1
+    if n % 2 == 0:
+        w[-1] = 1
+    # Exclude the mean
+    U[0, 0] = V[0, 0] = 0
+    N = n * n
+    var_u = np.sum(w * np.abs(U) ** 2) / N**2
+    var_v = np.sum(w * np.abs(V) ** 2) / N**2
+    cov_uv = np.sum(w * (U * np.conj(V)).real) / N**2
+    return var_u, var_v, cov_uv
 
-def find_rotation_ang_min_curl(DPCx, DPCy, step=1):
+
+def idpc_rotation_contrast(terms, angles):
+    """
+    Contrast (std) of the iDPC image at the given rotation angles
+    terms: variance terms from idpc_rotation_variance
+    angles: array of angles in degrees
+    """
+    var_u, var_v, cov_uv = terms
+    ang = np.asarray(angles) * np.pi / 180
+    c, s = np.cos(ang), np.sin(ang)
+    var = c**2 * var_u + s**2 * var_v + 2 * s * c * cov_uv
+    return np.sqrt(np.maximum(var, 0))
+
+
+def _refine_max_contrast(terms, ang, step, precision):
+    # Search around the best angle with 10 times finer steps until the precision
+    while step > precision:
+        fine = max(step / 10, precision)
+        angles = ang + np.arange(-step, step + fine / 2, fine)
+        ang = angles[np.argmax(idpc_rotation_contrast(terms, angles))]
+        step = fine
+    return ang
+
+
+def find_rotation_ang_min_curl(DPCx, DPCy, step=1, return_cost=False):
     """Try to find the scan rotation offset of DPC signals by minimizing the curl
+    The curl of the rotated field is cos(ang) C + sin(ang) D, with C and D the curl
+    and divergence of the input, so the cost sum(curl**2) is a quadratic form in
+    (cos, sin) that is minimized analytically from three sums over the pixels.
     DPCx, DPCy: 2d array of the same size
-    step: invertal of degrees when evaluating the curl in 0-360 degrees
-    Return: angle
+    step: invertal of degrees when evaluating the cost curve in 0-360 degrees
+    return_cost: if True, also return the angles and the cost curve
+    Return: angle in 0-180 degrees (angle + 180 gives the same curl),
+        and angles, cost if return_cost
     """
-    angles = np.arange(0, 360, step)
-    curls = []
-    for ang in angles:
-        Dx, Dy = rotate_vector(DPCx, DPCy, ang * np.pi / 180)
-        C = curl_2d(Dx, Dy)
-        curls.append(C)
+    C = curl_2d(DPCx, DPCy)
+    D = np.gradient(DPCx, axis=1) + np.gradient(DPCy, axis=0)
+    s_cc = np.sum(C**2)
+    s_dd = np.sum(D**2)
+    s_cd = np.sum(C * D)
+    del C, D
 
-    cost = [np.sum(c**2) for c in curls]
-    i_min = cost.index(min(cost))
-    return angles[i_min]
+    # cost = (s_cc + s_dd) / 2 + (s_cc - s_dd) / 2 cos(2 ang) + s_cd sin(2 ang)
+    ang = np.degrees(np.arctan2(-s_cd, -(s_cc - s_dd) / 2)) / 2 % 180
+    if not return_cost:
+        return ang
+    angles = np.arange(0, 360, step)
+    rad = angles * np.pi / 180
+    c, s = np.cos(rad), np.sin(rad)
+    cost = c**2 * s_cc + s**2 * s_dd + 2 * s * c * s_cd
+    return ang, angles, cost
 
 
 def curl_2d(Fx, Fy):
@@ -143,6 +369,8 @@ def rotate_vector(X, Y, ang):
     X, Y: array; components of vector along x and y
     ang: rotation angle in radian
     """
-    new_X = X * np.cos(ang) - Y * np.sin(ang)
-    new_Y = X * np.sin(ang) + Y * np.cos(ang)
+    # python floats keep the precision of X and Y
+    cos, sin = float(np.cos(ang)), float(np.sin(ang))
+    new_X = X * cos - Y * sin
+    new_Y = X * sin + Y * cos
     return new_X, new_Y
@@ -4,6 +4,9 @@
 GPA module
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from scipy.fft import fft2, fftshift, ifft2, ifftshift
 from scipy.ndimage import fourier_gaussian
@@ -11,45 +14,66 @@ from scipy.ndimage import center_of_mass
 from numba import njit, prange
 from .functions import norm_img
 
+# GPA calls its numba parallel kernels from worker threads (g vectors, tiles).
+# They share the lock of the filters, since any two parallel kernels running at
+# the same time abort under the workqueue threading layer.
+from .filters import _numba_lock
+
 
 # ===== GPA functions ==================================
 # Conventional GPA
-def get_phase_fft(img, k, r, edge_blur=0.3):
+def get_phase_fft(img, k, r, edge_blur=0.3, fft=None, dtype=np.float64):
     """Calculate phase from masked iFFT image
     Bansed on Hÿtch 1998
     r : int
         Size of the circular mask to place over the reflection
     edge_blur : float, optional
         Fraction of pixels at the edge that will be smoothed by a cosine function.
+    fft : numpy array, optional
+        Precomputed fftshift(fft2(img)), so it can be shared by several g vectors
+    dtype : float precision of the calculation, np.float64 or np.float32
     """
     im_y, im_x = img.shape
     cx, cy = im_x // 2, im_y // 2
-    x = np.arange(im_x)
-    y = np.arange(im_y)
-    X, Y = np.meshgrid(x, y)
 
     # calculate the fft and mask only on one side
-    fft = fftshift(fft2(img))
+    if fft is None:
+        fft = fftshift(fft2(img))
     kx, ky = k
     # need to calculate the coordinates for mask
     x = int(kx * im_x + cx)
     y = int(ky * im_y + cy)
-    m = create_mask((im_y, im_x), [(x, y)], [r], edge_blur)
-    fft_m = fft * m
+    m = create_mask((im_y, im_x), [(x, y)], [r], edge_blur).astype(dtype)
+    fft_m = fft.astype(complex_dtype(dtype), copy=False) * m
     # calculate complex valued ifft
     ifft_m = ifft2(ifftshift(fft_m))
     # raw phase
     phifft_m = np.angle(ifft_m)
-    # corrected phase
-    P = phifft_m - 2 * np.pi * (kx * X + ky * Y)
+    # corrected phase, the reference phase is taken modulo 2 pi so that it
+    # keeps its accuracy in single precision
+    ramp = np.mod(ky * np.arange(im_y), 1).astype(dtype)[:, None] + np.mod(
+        kx * np.arange(im_x), 1
+    ).astype(dtype)
+    P = phifft_m - 2 * np.pi * ramp
     return P
 
 
-def calc_strains(P, ks):
+def complex_dtype(dtype):
+    # Complex type with the same precision as a float type
+    return np.result_type(dtype, np.complex64)
+
+
+def modulation(k, n, dtype=np.float64):
+    # 1D exp(2 pi i k x), with the phase taken modulo 2 pi for precision
+    return np.exp(2j * np.pi * np.mod(k * np.arange(n), 1)).astype(complex_dtype(dtype))
+
+
+def calc_strains(P, ks, dPdx=None, dPdy=None):
     """
     Calculate strain with two g vectors and phases
     P : numpy array of phase image (2,m,n)
     ks: k vectors (2, 2)
+    dPdx, dPdy: optional precomputed phase derivatives (2,m,n)
     Returns
     -------
     im_exx : numpy array
@@ -63,13 +87,16 @@ def calc_strains(P, ks):
     """
     # Calculate the phase derivatives
 
-    dP1dy = calc_derivative(P[0, :, :], 0)
-    dP1dx = calc_derivative(P[0, :, :], 1)
-    dP2dy = calc_derivative(P[1, :, :], 0)
-    dP2dx = calc_derivative(P[1, :, :], 1)
+    if dPdx is None or dPdy is None:
+        dP1dx, dP1dy = phase_gradient(P[0, :, :])
+        dP2dx, dP2dy = phase_gradient(P[1, :, :])
+    else:
+        dP1dx, dP2dx = dPdx[0], dPdx[1]
+        dP1dy, dP2dy = dPdy[0], dPdy[1]
 
     # calculate lattice points a1 and a2
-    [a1x, a2x], [a1y, a2y] = np.linalg.inv(ks)
+    # as python floats so that they keep the precision of the derivatives
+    [a1x, a2x], [a1y, a2y] = np.linalg.inv(ks).tolist()
 
     # the strain components
     exx = -1 / (2 * np.pi) * (a1x * dP1dx + a2x * dP2dx)
@@ -91,14 +118,22 @@ def create_mask(img_size, center, radius, edge_blur=0.3):
     radius: lisf of float of the radius in pixel, length must be equal to center
     edge_blur: fload between 0-1 of the smoothed edge in fraction
     """
-    # Create a grid of coordinates
-    Y, X = np.ogrid[: img_size[0], : img_size[1]]
     mask = np.zeros(img_size, dtype=float)
 
     for i in range(len(center)):
         x_center, y_center = center[i]
         r = radius[i]
 
+        # Only the pixels in the bounding box of the circle need to be evaluated
+        x_min = max(int(np.floor(x_center - r)), 0)
+        x_max = min(int(np.ceil(x_center + r)) + 1, img_size[1])
+        y_min = max(int(np.floor(y_center - r)), 0)
+        y_max = min(int(np.ceil(y_center + r)) + 1, img_size[0])
+        if x_min >= x_max or y_min >= y_max:
+            continue  # Circle is outside of the image
+        Y, X = np.ogrid[y_min:y_max, x_min:x_max]
+        window = mask[y_min:y_max, x_min:x_max]
+
         # Calculate the Euclidean distance from each grid point to the circle's center
         distance = np.sqrt((X - x_center) ** 2 + (Y - y_center) ** 2)
 
@@ -107,20 +142,15 @@ def create_mask(img_size, center, radius, edge_blur=0.3):
         inside_circle = distance <= r - edge_width
         outside_circle = distance > r
 
-        mask[inside_circle] = 1
+        window[inside_circle] = 1
 
         if edge_blur != 0:
             # Transition zone
             transition_zone = ~inside_circle & ~outside_circle
 
             # Smooth edge with a cosine function
-
-            transition_distance = (distance - r) / edge_width
-            transition_mask = 0.5 * (1 + np.cos(np.pi * transition_distance))
-
-            # Combine masks
-
-            mask[transition_zone] = transition_mask[transition_zone]
+            transition_distance = (distance[transition_zone] - r) / edge_width
+            window[transition_zone] = 0.5 * (1 + np.cos(np.pi * transition_distance))
 
     return mask
 
@@ -160,29 +190,70 @@ def calc_derivative(arr, axis):
     """
     Calculate the derivative of a phase image.
     """
-    s1 = np.exp(-1j * arr)
-    s2 = np.exp(1j * arr)
-    d1 = np.gradient(s2, axis=axis)
-    # nd = np.min(d1.shape)
-    dP1x = s1 * d1
-    return dP1x.imag
+    dPdx, dPdy = phase_gradient(arr)
+    return dPdy if axis == 0 else dPdx
+
+
+def phase_gradient(P):
+    """
+    Calculate both derivatives of a phase image, ignoring 2 pi phase jumps.
+    Same as Im(exp(-iP) * gradient(exp(iP))) along each axis, which reduces to
+    the mean of the sines of the wrapped forward and backward differences
+    (one-sided at the edges, like np.gradient).
+    P: 2D phase array, float32 or float64
+    Returns: dPdx, dPdy with the precision of P
+    """
+    P = np.ascontiguousarray(P)
+    with _numba_lock:
+        return _phase_gradient(P)
+
+
+@njit(parallel=True, fastmath=True)
+def _phase_gradient(P):
+    ny, nx = P.shape
+    dPdx = np.empty_like(P)
+    dPdy = np.empty_like(P)
+    for i in prange(ny):
+        # d/dx along the row, reusing the forward difference of the last pixel
+        back = np.sin(P[i, 1] - P[i, 0])
+        dPdx[i, 0] = back
+        for j in range(1, nx - 1):
+            fwd = np.sin(P[i, j + 1] - P[i, j])
+            dPdx[i, j] = 0.5 * (back + fwd)
+            back = fwd
+        dPdx[i, nx - 1] = back
+
+        # d/dy of the row
+        if i == 0:
+            for j in range(nx):
+                dPdy[i, j] = np.sin(P[1, j] - P[0, j])
+        elif i == ny - 1:
+            for j in range(nx):
+                dPdy[i, j] = np.sin(P[i, j] - P[i - 1, j])
+        else:
+            for j in range(nx):
+                dPdy[i, j] = 0.5 * (
+                    np.sin(P[i + 1, j] - P[i, j]) + np.sin(P[i, j] - P[i - 1, j])
+                )
+    return dPdx, dPdy
 
 
 @njit(parallel=True, fastmath=True)
 def extract_strain_lstsqr(g, dPdx, dPdy):
     """
     g: (n,2) array of g-vectors
-    dPdx, dPdy: (n,m,m) phase derivatives
+    dPdx, dPdy: (n,my,mx) phase derivatives
     Solve Exx, Exy, Eyx, Eyy via least squares using normal equations (Numba-safe).
     """
     n = g.shape[0]
-    m = dPdx.shape[1]
+    my = dPdx.shape[1]
+    mx = dPdx.shape[2]
 
-    # Outputs
-    Exx = np.zeros((m, m), dtype=np.float64)
-    Exy = np.zeros((m, m), dtype=np.float64)
-    Eyx = np.zeros((m, m), dtype=np.float64)
-    Eyy = np.zeros((m, m), dtype=np.float64)
+    # Outputs, with the precision of the phase derivatives
+    Exx = np.zeros_like(dPdx[0])
+    Exy = np.zeros_like(dPdx[0])
+    Eyx = np.zeros_like(dPdx[0])
+    Eyy = np.zeros_like(dPdx[0])
 
     # Precompute normal equation matrices for the two 2x2 systems
     # System 1: [gx, gy] * [Exx, Exy]^T = b0
@@ -216,8 +287,8 @@ def extract_strain_lstsqr(g, dPdx, dPdy):
     c = -1.0 / (2.0 * np.pi)
 
     # Parallelize over pixels
-    for i in prange(m):
-        for j in range(m):
+    for i in prange(my):
+        for j in range(mx):
             # Build RHS vectors for the two systems
             # System 1: gx * Exx + gy * Exy = c * dPdx
             rhs0_0 = 0.0  # sum_k gx * c * dPdx[k,i,j]
@@ -261,7 +332,9 @@ def extract_strain_lstsqr(g, dPdx, dPdy):
 
 
 # Adaptive GPA with Windowed Fourier Ridge phase retrieval
-def get_phase_wfr(img, g, sigma, window_size, step):
+def get_phase_wfr(
+    img, g, sigma, window_size, step, batch_size=4, workers=-1, dtype=np.float64
+):
     """
     Calculate the phase from HRTEM image with a given g vector
     using the Windowed Fourier ridge technique.
@@ -276,37 +349,90 @@ def get_phase_wfr(img, g, sigma, window_size, step):
     sigma: for Gaussian filter
     window_size: window size for wfr algorithm, in pixel
     step: step size in pixel for wfr
+    batch_size: number of window frequencies transformed together
+    workers: number of threads for the batched FFTs, -1 uses all CPU cores
+    dtype: float precision of the calculation, np.float64 or np.float32
     Returns: phase as numpy array with the same size of img"""
 
     # Compute k vectors
     im_y, im_x = img.shape
     kx, ky = g
-    xx, yy = np.meshgrid(np.arange(im_x), np.arange(im_y))
+    cdtype = complex_dtype(dtype)
 
     # Compute window size and step
     kw = window_size * 1 / im_x
     kstep = step * 1 / im_x
+    wxs = np.arange(kx - kw, kx + kw, kstep)
+    wys = np.arange(ky - kw, ky + kw, kstep)
+
+    # Offsets of the window frequencies from g in FFT pixels
+    dxs = (wxs - kx) * im_x
+    dys = (wys - ky) * im_y
+    integer_shifts = np.allclose(dxs, np.rint(dxs)) and np.allclose(dys, np.rint(dys))
+
+    # Gaussian window in Fourier space, same as fourier_gaussian on the spectrum
+    gaussian = fourier_gaussian(np.ones((im_y, im_x), dtype=complex), sigma=sigma).real
+    gaussian = gaussian.astype(dtype)
+
+    if integer_shifts:
+        # Shifting the image frequency by an integer number of FFT pixels and
+        # demodulating it again is the same as shifting the Gaussian window, so
+        # a single spectrum of the image demodulated by g serves all windows.
+        multiplier = modulation(ky, im_y, dtype)[:, None] * modulation(kx, im_x, dtype)
+        X = fft2(img * multiplier)
+        del multiplier
+    candidates = [(wx, wy) for wx in wxs for wy in wys]
 
     g = {
         "phase": np.zeros_like(img),
         "r": np.zeros_like(img),
     }
-    for wx in np.arange(kx - kw, kx + kw, kstep):
-        for wy in np.arange(ky - kw, ky + kw, kstep):
-            multiplier = np.exp(np.pi * 2j * (xx * wx + yy * wy))
-            X = fft2(img * multiplier)
-            sf = ifft2(fourier_gaussian(X, sigma=sigma))
-            sf *= np.exp(-2j * np.pi * ((wx - kx) * xx + (wy - ky) * yy))
-            t = np.abs(sf) > g["r"]
-            g["r"][t] = np.abs(sf)[t]
-            g["phase"][t] = np.angle(sf)[t]
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start : start + batch_size]
+        spectra = np.empty((len(batch), im_y, im_x), dtype=cdtype)
+        for j, (wx, wy) in enumerate(batch):
+            if integer_shifts:
+                dx = int(np.rint((wx - kx) * im_x))
+                dy = int(np.rint((wy - ky) * im_y))
+                spectra[j] = X * np.roll(gaussian, (-dy, -dx), axis=(0, 1))
+            else:
+                multiplier = modulation(wy, im_y, dtype)[:, None] * modulation(
+                    wx, im_x, dtype
+                )
+                spectra[j] = fft2(img * multiplier) * gaussian
+        sf_batch = ifft2(spectra, axes=(-2, -1), workers=workers)
+        del spectra
+
+        # Keep the running maximum in the same order as the window frequencies
+        for j, (wx, wy) in enumerate(batch):
+            sf = sf_batch[j]
+            if not integer_shifts:
+                sf *= modulation(ky - wy, im_y, dtype)[:, None] * modulation(
+                    kx - wx, im_x, dtype
+                )
+            r = np.abs(sf)
+            t = r > g["r"]
+            g["r"][t] = r[t]
+            g["phase"][t] = np.angle(sf[t])
     phase = -g["phase"]  # Mysterious minus sign
     return phase
 
 
 # Put together one function overall
 def GPA(
-    img, g, algorithm="standard", r=20, edge_blur=0.3, sigma=10, window_size=10, step=4
+    img,
+    g,
+    algorithm="standard",
+    r=20,
+    edge_blur=0.3,
+    sigma=10,
+    window_size=10,
+    step=4,
+    workers=None,
+    roi=None,
+    tile_size=None,
+    margin=None,
+    dtype=np.float64,
 ):
     """Top level GPA function
     img: np array of square shape m x m
@@ -325,42 +451,335 @@ def GPA(
     sigma: float, sigma of the Gaussian window for WFT
     window_size: int, window size for WFR
     step: int, step for WFR
-    Return: strain tensors with the same size of img
+    workers: int, number of threads to process the g vectors (or tiles) in parallel.
+        None uses one thread per g vector (or tile), up to the number of CPU cores
+    roi: optional (x0, y0, x1, y1) region in image pixels. Strain is only computed
+        in this region, from a window extended by margin on each side.
+    tile_size: optional int, process the image (or roi) in square tiles of this size,
+        each extended by margin, and stitch the results. Memory stays bounded by
+        the tile size and the tiles run in parallel.
+    margin: int, apodization margin in pixels around the roi or tiles.
+        None uses twice the real space resolution of the mask (2 m / r) for
+        standard GPA and 4 sigma for adaptive GPA. Only standard GPA tapers the
+        margin, the Gaussian window of WFR is already local.
+    dtype: np.float64 (default) or np.float32. Single precision halves the memory
+        of the phase, derivative and strain arrays and uses complex64 FFTs.
+        The strain then differs from double precision by less than 1e-6 for
+        standard GPA. For adaptive GPA 99% of the pixels agree to 1e-7, isolated
+        pixels where two WFR windows are nearly tied can differ up to ~1e-3.
+    Return: strain tensors with the same size of img, or of the roi
     """
     # Normalize the input image
     img = norm_img(img)
     im_y, im_x = img.shape
-    n = len(g)
-    # FFT center coordinates
-    cx, cy = im_x // 2, im_y // 2
+    ks = get_ks(g, img.shape)
+
+    dtype = check_dtype(dtype)
+    params = {
+        "dtype": dtype,
+        "algorithm": algorithm,
+        "r": r,
+        "edge_blur": edge_blur,
+        "sigma": sigma,
+        "window_size": window_size,
+        "step": step,
+    }
+    if roi is None and tile_size is None:
+        return strain_from_ks(img, ks, workers=workers, **params)
+
+    # Region based GPA
+    if roi is None:
+        roi = (0, 0, im_x, im_y)
+    x0, y0, x1, y1 = [int(v) for v in roi]
+    x0, x1 = max(x0, 0), min(x1, im_x)
+    y0, y1 = max(y0, 0), min(y1, im_y)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(
+            f"Empty region of interest {roi} for image of shape {img.shape}."
+        )
+    if margin is None:
+        if algorithm == "standard":
+            margin = 2 * int(np.ceil(im_x / r))
+        else:
+            margin = int(np.ceil(4 * sigma))
+
+    if tile_size is None:
+        boxes = [(x0, y0, x1, y1)]
+    else:
+        boxes = [
+            (tx, ty, min(tx + tile_size, x1), min(ty + tile_size, y1))
+            for ty in range(y0, y1, tile_size)
+            for tx in range(x0, x1, tile_size)
+        ]
+
+    strain = np.zeros((4, y1 - y0, x1 - x0), dtype=dtype)
+
+    def process_box(box):
+        bx0, by0, bx1, by1 = box
+        tile, core = extract_region(
+            img,
+            box,
+            margin,
+            square=tile_size is not None,
+            apodize=algorithm == "standard",
+        )
+        tile_params = dict(params)
+        # Keep the mask radius constant in frequency units
+        tile_params["r"] = max(1, int(round(r * tile.shape[1] / im_x)))
+        result = strain_from_ks(tile, ks, workers=tile_workers, **tile_params)
+        cy0, cx0 = core
+        for c in range(4):
+            strain[c, by0 - y0 : by1 - y0, bx0 - x0 : bx1 - x0] = result[c][
+                cy0 : cy0 + by1 - by0, cx0 : cx0 + bx1 - bx0
+            ]
+
+    # Parallelize over the tiles when there are several, otherwise over g vectors
+    tile_workers = workers if len(boxes) == 1 else 1
+    run_parallel(process_box, boxes, workers)
+
+    exx, eyy, exy, oxy = strain
+    return exx, eyy, exy, oxy
 
-    P = np.zeros((n, im_y, im_x))
-    dPdx = np.zeros((n, im_y, im_x))
-    dPdy = np.zeros((n, im_y, im_x))
-    ks = np.zeros((n, 2))
 
-    # Calculate the phase from the g vector list
-    for i in range(n):
+def extract_region(img, box, margin, square=False, apodize=True):
+    """
+    Cut a region out of the image with an apodization margin around it
+    img: 2D image array
+    box: (x0, y0, x1, y1) of the region in pixels
+    margin: margin in pixels on each side. Beyond the image edges the window
+        continues periodically, which is what the FFT of the full image sees,
+        so regions at the border get the same margin and taper as inner ones.
+    square: extend the window to a square one
+    apodize: taper the margins with a cosine window
+    Returns: the apodized window and the (y, x) offset of the region in it
+    """
+    im_y, im_x = img.shape
+    x0, y0, x1, y1 = box
+    wx0, wx1 = x0 - margin, x1 + margin
+    wy0, wy1 = y0 - margin, y1 + margin
+    if square:
+        # Grow the short side on both ends
+        size = max(wx1 - wx0, wy1 - wy0)
+        wx0 -= (size - (wx1 - wx0)) // 2
+        wy0 -= (size - (wy1 - wy0)) // 2
+        wx1, wy1 = wx0 + size, wy0 + size
+
+    rows = np.arange(wy0, wy1) % im_y
+    cols = np.arange(wx0, wx1) % im_x
+    window = img[np.ix_(rows, cols)]
+    window -= window.mean()
+    if not apodize:
+        return window, (y0 - wy0, x0 - wx0)
+    # Cosine taper over the margins, the region itself is not modified
+    taper_y = _taper(wy1 - wy0, y0 - wy0, wy1 - y1)
+    taper_x = _taper(wx1 - wx0, x0 - wx0, wx1 - x1)
+    window *= (taper_y[:, None] * taper_x[None, :]).astype(window.dtype)
+    return window, (y0 - wy0, x0 - wx0)
+
+
+def _taper(n, lo, hi):
+    # 1D window that rises from 0 to 1 over lo pixels and falls over hi pixels
+    t = np.ones(n)
+    if lo > 0:
+        t[:lo] = 0.5 - 0.5 * np.cos(np.pi * (np.arange(lo) + 0.5) / lo)
+    if hi > 0:
+        t[n - hi :] = 0.5 + 0.5 * np.cos(np.pi * (np.arange(hi) + 0.5) / hi)
+    return t
+
+
+def check_dtype(dtype):
+    # GPA runs in single or double precision
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"GPA dtype must be float32 or float64, got {dtype}.")
+    return dtype
+
+
+def get_ks(g, shape):
+    """
+    Convert g vectors from FFT pixel coordinates to frequency units
+    g: list of g coordinates n x 2 in the FFT of an image
+    shape: shape of the image
+    Returns: (n, 2) array of k vectors in cycles per pixel
+    """
+    im_y, im_x = shape
+    # FFT center coordinates
+    cx, cy = im_x // 2, im_y // 2
+    ks = np.zeros((len(g), 2))
+    for i in range(len(g)):
         x, y = g[i]
         ks[i] = (x - cx) / im_x, (y - cy) / im_y
+    return ks
+
+
+def phase_derivatives(
+    img,
+    k,
+    algorithm="standard",
+    r=20,
+    edge_blur=0.3,
+    sigma=10,
+    window_size=10,
+    step=4,
+    fft=None,
+    dtype=np.float64,
+):
+    """
+    Retrieve the phase of one g vector and calculate its derivatives
+    k: g vector in frequency units
+    fft: optional precomputed fftshift(fft2(img)) for standard GPA
+    Other parameters are the same as GPA.
+    Returns: dPdx, dPdy
+    """
+    if algorithm == "standard":
+        P = get_phase_fft(img, k, r, edge_blur, fft=fft, dtype=dtype)
+    else:
+        P = get_phase_wfr(img, k, sigma, window_size, step, dtype=dtype)
+    return phase_gradient(P.astype(dtype, copy=False))
 
-        if algorithm == "standard":
-            P[i, :, :] = get_phase_fft(img, ks[i], r, edge_blur)
-        else:
-            P[i, :, :] = get_phase_wfr(img, ks[i], sigma, window_size, step)
-
-        # Calculate the phase derivative
-        dPdx[i, :, :] = calc_derivative(P[i, :, :], axis=1)
-        dPdy[i, :, :] = calc_derivative(P[i, :, :], axis=0)
 
-    # Calculate the strain tensors
-    if n > 2:
+def strain_from_derivatives(ks, dPdx, dPdy):
+    """
+    Solve the strain tensors from the phase derivatives of n g vectors
+    ks: (n, 2) k vectors
+    dPdx, dPdy: (n, m, m) phase derivatives
+    """
+    if len(ks) > 2:
         # use least square fit
-        exx, eyy, exy, oxy = extract_strain_lstsqr(ks, dPdx, dPdy)
+        with _numba_lock:
+            return extract_strain_lstsqr(ks, dPdx, dPdy)
+    # use standard method
+    return calc_strains(None, ks, dPdx=dPdx, dPdy=dPdy)
+
+
+def strain_from_ks(
+    img,
+    ks,
+    algorithm="standard",
+    r=20,
+    edge_blur=0.3,
+    sigma=10,
+    window_size=10,
+    step=4,
+    workers=None,
+    dtype=np.float64,
+):
+    """
+    Calculate the strain tensors of a normalized image from g vectors
+    in frequency units (cycles per pixel). Parameters are the same as GPA.
+    """
+    im_y, im_x = img.shape
+    n = len(ks)
+    dPdx = np.zeros((n, im_y, im_x), dtype=dtype)
+    dPdy = np.zeros((n, im_y, im_x), dtype=dtype)
+
+    # The spectrum is the same for all g vectors
+    fft = fftshift(fft2(img)) if algorithm == "standard" else None
+
+    def phase_and_derivative(i):
+        dPdx[i], dPdy[i] = phase_derivatives(
+            img,
+            ks[i],
+            algorithm,
+            r,
+            edge_blur,
+            sigma,
+            window_size,
+            step,
+            fft=fft,
+            dtype=dtype,
+        )
+
+    # FFTs and most numpy operations release the GIL, so threads run concurrently
+    run_parallel(phase_and_derivative, range(n), workers)
+
+    return strain_from_derivatives(ks, dPdx, dPdy)
+
+
+def run_parallel(func, items, workers=None):
+    # Run func on each item with a thread pool, one thread per item up to the CPU count
+    items = list(items)
+    if workers is None:
+        workers = min(len(items), os.cpu_count() or 1)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(func, items))
     else:
-        # use standard method
-        exx, eyy, exy, oxy = calc_strains(P, ks)
-    return exx, eyy, exy, oxy
+        for item in items:
+            func(item)
+
+
+class GPASession:
+    """
+    Interactive GPA on one image. The phase derivatives of each g vector are
+    cached with the parameters that produced them, so moving or resizing one
+    mask only recomputes that g vector and the final strain solve.
+    img: image array
+    workers: number of threads for the g vectors that need to be computed
+    dtype: np.float64 or np.float32, see GPA
+    """
+
+    def __init__(self, img, workers=None, dtype=np.float64):
+        self.raw = img
+        self.img = norm_img(img)
+        self.workers = workers
+        self.dtype = check_dtype(dtype)
+        self.fft = None
+        self.cache = {}
+
+    def matches(self, img):
+        # Whether the session was created for this image
+        return img.shape == self.raw.shape and np.array_equal(img, self.raw)
+
+    @staticmethod
+    def key(g, algorithm, r, edge_blur, sigma, window_size, step):
+        # Only the parameters used by the algorithm identify a result
+        g = (float(g[0]), float(g[1]))
+        if algorithm == "standard":
+            return (g, algorithm, r, edge_blur)
+        return (g, algorithm, sigma, window_size, step)
+
+    def run(
+        self,
+        g,
+        algorithm="standard",
+        r=20,
+        edge_blur=0.3,
+        sigma=10,
+        window_size=10,
+        step=4,
+    ):
+        """Same as GPA on the session image, reusing the cached g vectors"""
+        ks = get_ks(g, self.img.shape)
+        keys = [
+            self.key(gi, algorithm, r, edge_blur, sigma, window_size, step) for gi in g
+        ]
+        missing = [i for i in range(len(g)) if keys[i] not in self.cache]
+        if algorithm == "standard" and missing and self.fft is None:
+            self.fft = fftshift(fft2(self.img))
+
+        def compute(i):
+            self.cache[keys[i]] = phase_derivatives(
+                self.img,
+                ks[i],
+                algorithm,
+                r,
+                edge_blur,
+                sigma,
+                window_size,
+                step,
+                fft=self.fft,
+                dtype=self.dtype,
+            )
+
+        run_parallel(compute, missing, self.workers)
+
+        results = [self.cache[key] for key in keys]
+        # Only keep the g vectors in use, the others are stale
+        self.cache = dict(zip(keys, results))
+        dPdx = np.stack([dP[0] for dP in results])
+        dPdy = np.stack([dP[1] for dP in results])
+        return strain_from_derivatives(ks, dPdx, dPdy)
 
 
 def renormalize_phase(P):
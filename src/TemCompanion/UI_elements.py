@@ -3075,8 +3075,8 @@ class DPCDialog(QDialog):
         _, DPCx, DPCy = self.prepare_current_images()
         if DPCx is None:
             return
-        ang1, ang2 = find_rotation_ang_max_contrast(DPCx, DPCy)
-        text = f"Two possible rotation angles are {ang1} deg and {ang2} deg. Choose the one that gives the correct contrast!"
+        ang1, ang2 = find_rotation_ang_max_contrast(DPCx, DPCy, precision=0.1)
+        text = f"Two possible rotation angles are {ang1:.1f} deg and {ang2:.1f} deg. Choose the one that gives the correct contrast!"
         print(text)
         QMessageBox.information(self, "Rotation angle", text)
 
@@ -3085,7 +3085,9 @@ class DPCDialog(QDialog):
         if DPCx is None:
             return
         ang = find_rotation_ang_min_curl(DPCx, DPCy)
-        text = f"The possible rotation angle that gives the minimum curl is {ang} deg."
+        text = (
+            f"The possible rotation angle that gives the minimum curl is {ang:.1f} deg."
+        )
         print(text)
         QMessageBox.information(self, "Rotation angle", text)
 
@@ -66,6 +66,7 @@ from .functions import (
     getFileNameType,
     save_as_tif16,
     save_with_pil,
+    save_npy,
     find_img_by_title,
     apply_filter_on_img_dict,
     calculate_angle_to_horizontal,
@@ -73,7 +74,7 @@ from .functions import (
 )
 
 from . import filters
-from .GPA import GPA, norm_img, create_mask, refine_center
+from .GPA import GPASession, norm_img, create_mask, refine_center
 
 
 class PlotCanvas(QMainWindow):
@@ -937,7 +938,7 @@ class PlotCanvas(QMainWindow):
 
             elif self.selected_type == "Numpy Array Files (*.npy)":
                 img_dict = self.get_original_img_dict()
-                np.save(self.file_path, img_dict["data"])
+                save_npy(self.file_path, img_dict["data"])
 
             else:
                 # Save the current data only
@@ -2620,6 +2621,8 @@ class PlotCanvas(QMainWindow):
             selector=True, buttons=True, modes=True, status_bar=True
         )  # Clean up any existing modes or selectors
         self.live_fft(fullsize=True, windowed=True, resize_fft=True)
+        # Phase results are cached per g vector while the masks are adjusted
+        self.gpa_session = None
         # Resize the selector to be the whole image
         self.canvas.selector[0].setPos((0, 0))
         self.canvas.selector[0].setSize(
@@ -2708,6 +2711,7 @@ class PlotCanvas(QMainWindow):
             selector=True, buttons=True, modes=True, status_bar=True
         )
         self.clean_up(selector=True, modes=True, status_bar=True)
+        self.gpa_session = None
 
     def run_gpa(self):
         img = self.get_img_dict_from_canvas()
@@ -2743,11 +2747,13 @@ class PlotCanvas(QMainWindow):
         step_size = self.attribute["gpa"]["step_size"]
         window_size = self.attribute["gpa"]["window_size"]
 
+        if self.gpa_session is None or not self.gpa_session.matches(data):
+            self.gpa_session = GPASession(data)
+
         title = self.canvas.canvas_name
-        # Run GPA in a separate thread
+        # Run GPA in a separate thread, only the changed g vectors are recomputed
         self.worker = Worker(
-            GPA,
-            data,
+            self.gpa_session.run,
             g,
             algorithm=algorithm,
             r=r,
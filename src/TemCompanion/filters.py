@@ -1,8 +1,20 @@
+from functools import lru_cache
+import threading
+
 import numpy as np
-from scipy.fft import fft2, fftshift, ifftshift, ifft2
+from scipy.fft import fft2, fftshift, ifftshift, ifft2, rfft2, irfft2
 from scipy.signal import medfilt2d
 from numba import njit, prange
 
+# Maximum number of frequency-domain kernels kept in memory.
+# A 4k x 4k float64 kernel takes 128 MB, so keep this small.
+KERNEL_CACHE_SIZE = 8
+
+# Numba parallel kernels may be called from several worker threads when filtering
+# stacks, but the default workqueue threading layer is not thread-safe.
+# Every parallel kernel of the package (also in GPA) runs under this one lock.
+_numba_lock = threading.Lock()
+
 
 # Crop the input images if they are not square
 def crop_to_square(img):
@@ -44,14 +56,118 @@ def pad_to_square(img):
 # For radial integration, convert image indices to polar coordinates
 def img_to_polar(img):
     # Feed an image array, generate a polar indices array
-    y, x = np.indices(img.shape)
-    center = img.shape[0] // 2, img.shape[1] // 2
+    return polar_grid(img.shape)  # rho is the radial distance
+
+
+def polar_grid(shape):
+    # Radial distance of each pixel from the center (shape // 2) of a grid
+    y, x = np.indices(shape)
+    center = shape[0] // 2, shape[1] // 2
     x = x - center[0]
     y = y - center[1]
     rho = np.hypot(y, x)  # calculate sqrt(x**2 + y**2)
-    # rho = rho.astype(int) # Convert rho to int for simplicity
     # phi = np.arctan2(y, x) # Don't need this
-    return rho  # rho is the radial distance
+    return rho
+
+
+# Frequency-domain kernels are shared by all filters and cached by their parameters
+@lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def _filter_kernel(shape, filter_type, order, cutoff_ratio, hp_cutoff_ratio, half):
+    if filter_type in ["butterworth", "gaussian"]:
+        r = polar_grid(shape)
+
+    if filter_type == "butterworth":
+        kernel = 1 / (1 + 0.414 * (r / (cutoff_ratio * shape[0])) ** (2 * order))
+
+    elif filter_type == "gaussian":
+        if cutoff_ratio > 0 and cutoff_ratio < 1:
+            cutoff = shape[0] * cutoff_ratio
+            kernel = np.exp(-(r**2) / (2 * (cutoff**2)))
+        else:
+            # No filtering outside the valid range
+            kernel = np.ones(shape, dtype=np.float64)
+        if hp_cutoff_ratio > 0 and hp_cutoff_ratio < 1:
+            hp_cutoff = shape[0] * hp_cutoff_ratio
+            kernel = kernel * (1 - np.exp(-(r**2) / (2 * (hp_cutoff**2))))
+
+    elif filter_type == "noedge":
+        # Real-space Butterworth window used to suppress the edge effect,
+        # centered at (size + 1) / 2
+        y, x = np.indices(shape)
+        x = x - (shape[0] + 1) / 2
+        y = y - (shape[1] + 1) / 2
+        r = np.hypot(y, x)
+        kernel = 1 / (1 + 0.414 * (r / (cutoff_ratio * shape[0])) ** (2 * order))
+
+    else:
+        raise ValueError(f"Unknown filter kernel type: {filter_type}")
+
+    if half:
+        # Radially symmetric kernels need no symmetrization for the half plane
+        kernel = np.ascontiguousarray(ifftshift(kernel)[:, : shape[1] // 2 + 1])
+
+    # Cached arrays are shared between callers, so they must not be modified
+    kernel.setflags(write=False)
+    return kernel
+
+
+def get_filter_kernel(
+    shape, filter_type, order=0, cutoff_ratio=0, hp_cutoff_ratio=0, half=False
+):
+    """
+    Get a (cached) filter kernel in the fftshifted frequency layout
+    shape: tuple of the full kernel shape
+    filter_type: 'butterworth', 'gaussian', or 'noedge'
+    order: Butterworth order
+    cutoff_ratio: cutoff ratio in frequency domain
+    hp_cutoff_ratio: high pass cutoff ratio, only used by 'gaussian'
+    half: if True, return the unshifted half plane matching the rfft2 layout
+    Return: read-only float64 array
+    """
+    shape = tuple(int(i) for i in shape)
+    return _filter_kernel(
+        shape,
+        filter_type,
+        order,
+        float(cutoff_ratio),
+        float(hp_cutoff_ratio),
+        bool(half),
+    )
+
+
+def kernel_cache_info():
+    """
+    Return the hits, misses, maxsize and currsize of the filter kernel cache
+    """
+    return _filter_kernel.cache_info()
+
+
+def clear_kernel_cache():
+    _filter_kernel.cache_clear()
+
+
+# Helpers for the real-input (rfft2) code path
+def _full_magnitude(f_half, shape):
+    # Rebuild the full unshifted |FFT| of a real image from its rfft2
+    # using the Hermitian symmetry F(-k) = conj(F(k))
+    mag = np.empty(shape, dtype=np.float64)
+    h = f_half.shape[1]
+    mag[:, :h] = np.abs(f_half)
+    n_missing = shape[1] - h
+    if n_missing > 0:
+        mirrored = np.abs(f_half[::-1, n_missing:0:-1])
+        mag[:, h:] = np.roll(mirrored, 1, axis=0)
+    return mag
+
+
+def _half_plane(weight):
+    # Convert a full real weight in the fftshifted layout to the rfft2 half plane.
+    # The weight is symmetrized as (W(k) + W(-k)) / 2 so that irfft2 gives the
+    # same result as the real part of the full complex ifft2.
+    w = ifftshift(weight)
+    h = w.shape[1] // 2 + 1
+    w_neg = np.roll(w[::-1, ::-1], 1, axis=(0, 1))
+    return 0.5 * (w[:, :h] + w_neg[:, :h])
 
 
 # Gaussian low pass filter
@@ -66,24 +182,25 @@ def gaussian_lowpass(img, cutoff_ratio, hp_cutoff_ratio=0, space="real"):
     img_shape = img.shape
     if img_shape[0] != img_shape[1]:
         img = pad_to_square(img)
-    r = img_to_polar(img)
-
-    # Calculate the cutoff frequency
-    if cutoff_ratio > 0 and cutoff_ratio < 1:
-        cutoff = r.shape[0] * cutoff_ratio
-
-        # Create Gaussian mask
-        lp_gaussian_filter = np.exp(-(r**2) / (2 * (cutoff**2)))
-    else:
-        # No filtering outside the valid range
-        lp_gaussian_filter = np.ones_like(r, dtype=np.float64)
-
-    if hp_cutoff_ratio > 0 and hp_cutoff_ratio < 1:
-        hp_cutoff = r.shape[0] * hp_cutoff_ratio
-        hp_gaussian_filter = 1 - np.exp(-(r**2) / (2 * (hp_cutoff**2)))
-    else:
-        # No filtering outside the valid range
-        hp_gaussian_filter = np.ones_like(r, dtype=np.float64)
+    if space == "real" and not np.iscomplexobj(img):
+        # Real input, only half of the spectrum is needed
+        gaussian_filter = get_filter_kernel(
+            img.shape,
+            "gaussian",
+            cutoff_ratio=cutoff_ratio,
+            hp_cutoff_ratio=hp_cutoff_ratio,
+            half=True,
+        )
+        img_glp = irfft2(rfft2(img) * gaussian_filter, s=img.shape)
+        img_glp = img_glp[: img_shape[0], : img_shape[1]]
+        return img_glp
+
+    gaussian_filter = get_filter_kernel(
+        img.shape,
+        "gaussian",
+        cutoff_ratio=cutoff_ratio,
+        hp_cutoff_ratio=hp_cutoff_ratio,
+    )
 
     if space == "real":
         # Compute the FFT to find the frequency transform
@@ -91,7 +208,7 @@ def gaussian_lowpass(img, cutoff_ratio, hp_cutoff_ratio=0, space="real"):
     elif space == "fourier":
         fshift = img
     # Apply the filter to the frequency domain representation of the image
-    filtered_fshift = fshift * lp_gaussian_filter * hp_gaussian_filter
+    filtered_fshift = fshift * gaussian_filter
 
     # Apply the inverse FFT to return to the spatial domain
     img_glp = ifft2(ifftshift(filtered_fshift)).real
@@ -109,8 +226,18 @@ def bw_lowpass(img, order, cutoff_ratio):
     img_shape = img.shape
     if img_shape[0] != img_shape[1]:
         img = pad_to_square(img)
-    r = img_to_polar(img)  # Convert to polar indices
-    bw = 1 / (1 + 0.414 * (r / (cutoff_ratio * r.shape[0])) ** (2 * order))
+    if not np.iscomplexobj(img):
+        # Real input, only half of the spectrum is needed
+        bw = get_filter_kernel(
+            img.shape, "butterworth", order=order, cutoff_ratio=cutoff_ratio, half=True
+        )
+        img_bw = irfft2(rfft2(img) * bw, s=img.shape)
+        img_bw = img_bw[: img_shape[0], : img_shape[1]]
+        return img_bw
+
+    bw = get_filter_kernel(
+        img.shape, "butterworth", order=order, cutoff_ratio=cutoff_ratio
+    )
 
     # Compute the FFT to find the frequency transform
     fshift = fftshift(fft2(img))
@@ -125,34 +252,58 @@ def bw_lowpass(img, order, cutoff_ratio):
 
 
 # Radial integration
-def radial_integration(img, bin=1, return_masks=False):
+@lru_cache(maxsize=4)
+def _radial_bin_index(shape, bin):
     # Get the polar indices array
-    r = img_to_polar(img)
+    r = polar_grid(shape)
 
     r_max = np.max(r)
     # Get the bin indices for each pixel
     bins = np.arange(0, r_max + bin, bin)
-    bin_indices = np.digitize(r, bins) - 1
-    bins = bins[: img.shape[0] // 2]  # Limit the bins to half the image size
+    bin_indices = (np.digitize(r, bins) - 1).ravel()
+    bins = bins[: shape[0] // 2]  # Limit the bins to half the image size
+    n_bins = len(bins) - 1
+
+    # CSR-style index: flat pixel indices sorted by bin, and the start of each bin.
+    # Pixels of bin i are pixel_index[offsets[i] : offsets[i + 1]], in row-major order.
+    counts = np.bincount(bin_indices, minlength=n_bins)[:n_bins]
+    offsets = np.zeros(n_bins + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    index_dtype = np.int32 if bin_indices.size < 2**31 else np.int64
+    pixel_index = np.argsort(bin_indices, kind="stable")[: offsets[-1]]
+    pixel_index = pixel_index.astype(index_dtype)
+
+    for arr in (bins, bin_indices, pixel_index, offsets):
+        arr.setflags(write=False)
+    return bins[:-1], bin_indices, pixel_index, offsets
+
+
+def radial_bin_index(shape, bin=1):
+    """
+    Get the (cached) radial bin index of a given image shape
+    shape: tuple of the image shape
+    bin: bin width in pixel
+    Return: bins, bin index of each pixel (flattened), pixel indices sorted by bin,
+    and bin offsets into the sorted pixel indices
+    """
+    return _radial_bin_index(tuple(int(i) for i in shape), bin)
+
+
+def radial_integration(img, bin=1, return_masks=False):
+    bins, bin_indices, pixel_index, offsets = radial_bin_index(img.shape, bin)
     # Sum values in each bin
     radial_profile = np.bincount(
-        bin_indices.flatten(), weights=img.flatten(), minlength=len(bins)
+        bin_indices, weights=img.ravel(), minlength=len(bins) + 1
     )
-    radial_profile = radial_profile[: len(bins) - 1]
-
-    # # Sum the image values within each bin
-    # radial_profile = np.array([img[bin_indices == i].mean() for i in range(len(bins)-1)])
+    radial_profile = radial_profile[: len(bins)]
 
     if return_masks:
-        # Create masks for each bin
-        bin_range = np.arange(len(bins) - 1)
-        masks = bin_indices == bin_range[:, None, None]
-        # masks = np.zeros((len(bins)-1, img.shape[0], img.shape[1]), dtype=bool)
-        # for i in range(len(bins)-1):
-        #     masks[i][bin_indices == i] = True
-        return bins[:-1], radial_profile, masks
+        # Create masks for each bin. This is (n_bins, H, W), use radial_bin_index
+        # instead for large images
+        masks = bin_indices.reshape(img.shape) == np.arange(len(bins))[:, None, None]
+        return bins, radial_profile, masks
     else:
-        return bins[:-1], radial_profile
+        return bins, radial_profile
 
 
 # Function to get an averaged background from a real-space HR image
@@ -163,64 +314,46 @@ def get_avg_background(img, delta=5):
     img: 2D array of real-space HR image data
     delta: a threashold for background averaging
     """
-    # Get the polar indices array
-    # r = img_to_polar(img)
-    y, x = np.indices(img.shape)
-    center = (img.shape[0] + 1) / 2, (img.shape[1] + 1) / 2
-    x = x - center[0]
-    y = y - center[1]
-    r = np.hypot(y, x)
-
     # Get a Butterworth filter on image to remove the edge effect
-    noedgebw = 1 / (1 + 0.414 * (r / (0.4 * r.shape[0])) ** (2 * 12))
+    noedgebw = get_filter_kernel(img.shape, "noedge", order=12, cutoff_ratio=0.4)
     noedgeimg = img * noedgebw
-    f_noedge = fftshift(fft2(noedgeimg))
+    if np.iscomplexobj(noedgeimg):
+        f_noedge = np.abs(fft2(noedgeimg))
+    else:
+        f_noedge = _full_magnitude(rfft2(noedgeimg), noedgeimg.shape)
     # Light filter the FFT for processing
-    f_mag = medfilt2d(np.abs(f_noedge), kernel_size=5)
-
-    # Get the radial integration and masks
+    f_mag = medfilt2d(fftshift(f_noedge), kernel_size=5)
 
-    _, f_mean, masks = radial_integration(f_mag, return_masks=True)
+    # Get the radial integration and the bin index
+    _, f_mean = radial_integration(f_mag)
+    _, _, pixel_index, offsets = radial_bin_index(f_mag.shape)
 
-    f_mag = remove_peaks_bin(f_mag, masks, f_mean, delta=delta)
+    f_mag = remove_peaks_bin(f_mag, pixel_index, offsets, f_mean, delta=delta)
 
     return f_mag
 
 
 @njit(parallel=True, fastmath=True)
-def remove_peaks_bin(img, masks, means, delta=5):
-    """
-    Optimized version that pre-extracts ROI coordinates for faster iteration.
-    """
+def _remove_peaks_bin(img_flat, pixel_index, offsets, means, delta):
     delta_factor = 1.0 + delta / 100.0
-    img_out = img.copy()
+    img_out = img_flat.copy()
 
     for i in prange(len(means)):
-        if means[i] <= 0:
-            continue
+        start = offsets[i]
+        end = offsets[i + 1]
+        count = end - start
+        if means[i] <= 0 or count == 0:
+            continue  # Skip empty bins
 
-        mask = masks[i]
         mean_val = means[i] * delta_factor
         diff_pc = np.inf
         iter_count = 0
         max_iter = 100
 
-        # Extract ROI data
-        roi = []
-        roi_coords = []
-        for y in range(mask.shape[0]):
-            for x in range(mask.shape[1]):
-                if mask[y, x]:
-                    roi.append(img[y, x])
-                    roi_coords.append((y, x))
-
-        if not roi:
-            continue  # Skip empty masks
-
         while diff_pc > delta and mean_val > 0 and iter_count < max_iter:
-            sum_roi = 0
-            count = len(roi_coords)
-            for point in roi:
+            sum_roi = 0.0
+            for k in range(start, end):
+                point = img_flat[pixel_index[k]]
                 if point > mean_val:
                     point = mean_val
                 sum_roi += point
@@ -237,13 +370,98 @@ def remove_peaks_bin(img, masks, means, delta=5):
             iter_count += 1
 
         # Write the final mean value to the image
-        for coord in roi_coords:
-            y, x = coord
-            img_out[y, x] = mean_val
+        for k in range(start, end):
+            img_out[pixel_index[k]] = mean_val
 
     return img_out
 
 
+def remove_peaks_bin(img, pixel_index, offsets, means, delta=5):
+    """
+    Replace the pixels of each radial bin by an iteratively clipped mean
+    img: 2D array
+    pixel_index, offsets: radial bin index from radial_bin_index
+    means: radial profile of img
+    delta: a threashold in percent for the iteration
+    """
+    img_flat = np.ascontiguousarray(img).ravel()
+    with _numba_lock:
+        img_out = _remove_peaks_bin(img_flat, pixel_index, offsets, means, delta)
+    return img_out.reshape(img.shape)
+
+
+# Wiener and ABS filters share the same frequency-domain pipeline
+def _background_subtraction_weight(
+    img, f_img, weight, delta=5, lowpass=True, lowpass_cutoff=0.3, lowpass_order=2
+):
+    """
+    Frequency-domain weight of the Wiener or ABS filter, including the optional
+    Butterworth lowpass
+    img: square image array
+    f_img: rfft2 of img if img is real, otherwise the fftshifted fft2
+    weight: 'wiener' or 'abs'
+    Return: weight array in the same layout as f_img
+    """
+    real_input = not np.iscomplexobj(img)
+    if real_input:
+        fu = fftshift(_full_magnitude(f_img, img.shape))
+    else:
+        fu = np.abs(f_img)
+    fa = get_avg_background(img, delta=delta)
+    # fu can be exactly zero, e.g. at the DC pixel of a highpass filtered spectrum
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if weight == "wiener":
+            fu_squared = np.square(fu)
+            fa_squared = np.square(fa)
+            w = (fu_squared - fa_squared) / fu_squared
+        else:
+            w = (fu - fa) / fu
+    w[np.isnan(w)] = 0
+    w[w < 0] = 0
+
+    if real_input:
+        w = _half_plane(w)
+    if lowpass:
+        w *= get_filter_kernel(
+            img.shape,
+            "butterworth",
+            order=lowpass_order,
+            cutoff_ratio=lowpass_cutoff,
+            half=real_input,
+        )
+    return w
+
+
+def _background_subtraction_filter(
+    img, weight, delta=5, lowpass=True, lowpass_cutoff=0.3, lowpass_order=2
+):
+    """
+    Filter a square image with a single FFT round trip. The Wiener or ABS weight
+    and the optional Butterworth lowpass are multiplied in frequency space.
+    img: square image array
+    weight: 'wiener' or 'abs'
+    Return: filtered image array with the same shape as img
+    """
+    real_input = not np.iscomplexobj(img)
+    if real_input:
+        f_img = rfft2(img)
+    else:
+        f_img = fftshift(fft2(img))
+    w = _background_subtraction_weight(
+        img,
+        f_img,
+        weight,
+        delta=delta,
+        lowpass=lowpass,
+        lowpass_cutoff=lowpass_cutoff,
+        lowpass_order=lowpass_order,
+    )
+
+    if real_input:
+        return irfft2(f_img * w, s=img.shape)
+    return ifft2(ifftshift(f_img * w)).real
+
+
 # Wiener filter function
 def wiener_filter(img, delta=5, lowpass=True, lowpass_cutoff=0.3, lowpass_order=2):
     """
@@ -259,19 +477,16 @@ def wiener_filter(img, delta=5, lowpass=True, lowpass_cutoff=0.3, lowpass_order=
     if img_shape[0] != img_shape[1]:
         img = pad_to_square(img)
 
-    f_img = fftshift(fft2(img))
-    fu = np.abs(f_img)
-    fa = get_avg_background(img, delta=delta)
-    fu_squared = np.square(fu)
-    fa_squared = np.square(fa)
-    wf = (fu_squared - fa_squared) / fu_squared
-    wf[wf < 0] = 0
-    f_img_wf = f_img * wf
-    img_wf_padded = ifft2(ifftshift(f_img_wf)).real
-    img_wf = img_wf_padded[: img_shape[0], : img_shape[1]]
+    img_wf = _background_subtraction_filter(
+        img,
+        "wiener",
+        delta=delta,
+        lowpass=lowpass,
+        lowpass_cutoff=lowpass_cutoff,
+        lowpass_order=lowpass_order,
+    )
+    img_wf = img_wf[: img_shape[0], : img_shape[1]]
     img = img[: img_shape[0], : img_shape[1]]
-    if lowpass:
-        img_wf = bw_lowpass(img_wf, lowpass_order, lowpass_cutoff)
     img_wf = np.single(img_wf)
     img_diff = img - img_wf
     return img_wf, img_diff
@@ -291,24 +506,35 @@ def abs_filter(img, delta=5, lowpass=True, lowpass_cutoff=0.3, lowpass_order=2):
     img_shape = img.shape
     if img_shape[0] != img_shape[1]:
         img = pad_to_square(img)
-    f_img = fftshift(fft2(img))
-    fu = np.abs(f_img)
-    fa = get_avg_background(img, delta=delta)
-    absf = (fu - fa) / fu
-    absf[absf < 0] = 0
-    f_img_absf = f_img * absf
-    img_absf = ifft2(ifftshift(f_img_absf)).real
+
+    img_absf = _background_subtraction_filter(
+        img,
+        "abs",
+        delta=delta,
+        lowpass=lowpass,
+        lowpass_cutoff=lowpass_cutoff,
+        lowpass_order=lowpass_order,
+    )
     img_absf = img_absf[: img_shape[0], : img_shape[1]]
     img = img[: img_shape[0], : img_shape[1]]
-    if lowpass:
-        img_absf = bw_lowpass(img_absf, lowpass_order, lowpass_cutoff)
     img_absf = np.single(img_absf)
     img_diff = img - img_absf
     return img_absf, img_diff
 
 
 # Nonlinear filter function
-def nlfilter(img, N=50, delta=10, lowpass_cutoff=0.3, lowpass=True, lowpass_order=2):
+def nlfilter(
+    img,
+    N=50,
+    delta=10,
+    lowpass_cutoff=0.3,
+    lowpass=True,
+    lowpass_order=2,
+    space="fourier",
+    tol=0,
+    checkpoint=0,
+    callback=None,
+):
     """
     Non-linear filter
     img: img 2D-array
@@ -316,28 +542,106 @@ def nlfilter(img, N=50, delta=10, lowpass_cutoff=0.3, lowpass=True, lowpass_orde
     lowpass_cutoff: cutoff of the low pass filter
     lowpass: apply a Butterworth lowpass filter after Wiener filter
     The Butterworth filter will use lowpass_order and lowpass_cutoff
+    space: 'fourier' keeps the image spectrum between iterations and only returns
+    to real space for the background estimation; 'real' runs each iteration with
+    gaussian_lowpass and wiener_filter. Complex images always use 'real'.
+    tol: stop early when the relative change between two iterations is below tol.
+    If tol = 0, all N iterations are run.
+    checkpoint: if > 0, call callback(i, img) with the intermediate real-space image
+    every checkpoint iterations
     Return: filtered image array and difference
     """
     img_shape = img.shape
     if img_shape[0] != img_shape[1]:
         img = pad_to_square(img)
-    x_in = img
+
+    if space == "fourier" and not np.iscomplexobj(img):
+        x_in = _nlfilter_fourier(
+            img,
+            N,
+            delta,
+            lowpass_cutoff,
+            lowpass,
+            lowpass_order,
+            tol=tol,
+            checkpoint=checkpoint,
+            callback=callback,
+        )
+    else:
+        x_in = img
+        i = 0
+        while i < N:
+            x_lp = gaussian_lowpass(x_in, lowpass_cutoff)
+            x_diff = x_in - x_lp
+            x_diff_wf, _ = wiener_filter(
+                x_diff,
+                delta=delta,
+                lowpass=lowpass,
+                lowpass_cutoff=lowpass_cutoff,
+                lowpass_order=lowpass_order,
+            )
+            x_out = x_lp + x_diff_wf
+            i = i + 1
+            if checkpoint > 0 and callback is not None and i % checkpoint == 0:
+                callback(i, x_out[: img_shape[0], : img_shape[1]])
+            if tol > 0 and _relative_change(x_out, x_in) < tol:
+                x_in = x_out
+                break
+            x_in = x_out
+
+    img_filtered = x_in[: img_shape[0], : img_shape[1]]
+    img_filtered = np.single(img_filtered)  # Convert to 32 bit float
+    img = img[: img_shape[0], : img_shape[1]]
+    img_diff = img - img_filtered
+    return img_filtered, img_diff
+
+
+def _nlfilter_fourier(
+    img,
+    N,
+    delta,
+    lowpass_cutoff,
+    lowpass,
+    lowpass_order,
+    tol=0,
+    checkpoint=0,
+    callback=None,
+):
+    # Run the non-linear iterations on the rfft2 spectrum of a real square image.
+    # Each iteration splits the spectrum into the Gaussian lowpass part and the
+    # high frequency part; only the latter is Wiener filtered.
+    img_shape = img.shape
+    g = get_filter_kernel(img_shape, "gaussian", cutoff_ratio=lowpass_cutoff, half=True)
+    f_in = rfft2(img)
     i = 0
     while i < N:
-        x_lp = gaussian_lowpass(x_in, lowpass_cutoff)
-        x_diff = x_in - x_lp
-        x_diff_wf, _ = wiener_filter(
+        f_diff = f_in * (1 - g)
+        # The background estimation works on the real-space difference image
+        x_diff = irfft2(f_diff, s=img_shape)
+        w = _background_subtraction_weight(
             x_diff,
+            f_diff,
+            "wiener",
             delta=delta,
             lowpass=lowpass,
             lowpass_cutoff=lowpass_cutoff,
             lowpass_order=lowpass_order,
         )
-        x_in = x_lp + x_diff_wf
+        f_out = f_in * g + f_diff * w
         i = i + 1
-
-    img_filtered = x_in[: img_shape[0], : img_shape[1]]
-    img_filtered = np.single(img_filtered)  # Convert to 32 bit float
-    img = img[: img_shape[0], : img_shape[1]]
-    img_diff = img - img_filtered
-    return img_filtered, img_diff
+        if checkpoint > 0 and callback is not None and i % checkpoint == 0:
+            callback(i, irfft2(f_out, s=img_shape))
+        if tol > 0 and _relative_change(f_out, f_in) < tol:
+            f_in = f_out
+            break
+        f_in = f_out
+
+    return irfft2(f_in, s=img_shape)
+
+
+def _relative_change(new, old):
+    # Relative change between two iterations, valid in real or Fourier space
+    norm = np.linalg.norm(old)
+    if norm == 0:
+        return 0.0
+    return np.linalg.norm(new - old) / norm
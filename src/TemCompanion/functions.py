@@ -16,8 +16,18 @@ import os
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import copy
+import hashlib
 import json
 import pickle
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
 
 from PyQt5.QtWidgets import (
     QApplication,
@@ -95,48 +105,146 @@ def getFileNameType(path):
     return name, ext
 
 
-def apply_filter(img, filter_type, **kwargs):
+def apply_filter(
+    img,
+    filter_type,
+    workers=None,
+    pool="thread",
+    progress_callback=None,
+    out=None,
+    **kwargs,
+):
     """Wrapper function to apply different filters
     img: 2D or 3D numpy array
     filter_type: 'Wiener', 'ABS', 'NL', 'BW', 'Gaussian'
+    workers: number of workers to filter the frames of a 3D stack in parallel.
+        None uses up to 8 CPU cores, 1 filters the frames one by one
+    pool: 'thread' or 'process' workers for 3D stacks
+    progress_callback: function called as progress_callback(n_done, n_total)
+        each time a frame of a 3D stack is filtered
+    out: optional preallocated output for 3D stacks with the same shape as img,
+        e.g. a np.memmap or a chunked h5py Dataset. Frames are written into it as
+        soon as they are filtered, so the full result never needs to be in RAM.
     kwargs: parameters for different filters
+    Return: filtered 2D array, or float32 3D array (or out) for stacks
     """
-    filter_dict = {
-        "Wiener": filters.wiener_filter,
-        "ABS": filters.abs_filter,
-        "NL": filters.nlfilter,
-        "BW": filters.bw_lowpass,
-        "Gaussian": filters.gaussian_lowpass,
-    }
     if img.ndim == 2:
         # Apply the selected filter only on 2D array
-        if filter_type in filter_dict.keys():
-            result = filter_dict[filter_type](img, **kwargs)
-            if filter_type in ["Wiener", "ABS", "NL"]:
-                return result[0]
-            elif filter_type in ["BW", "Gaussian"]:
-                return result
+        return filter_frame(img, filter_type, kwargs)
     elif img.ndim == 3:
         # Apply to image stacks
-        img_shape = img.shape
-        result = np.zeros(img_shape)
-        for i in range(img_shape[0]):
-            result_i = apply_filter(img[i], filter_type, **kwargs)
-            result[i] = result_i
+        n_frames = img.shape[0]
+        if out is None:
+            result = np.empty(img.shape, dtype=np.float32)
+        elif tuple(out.shape) != img.shape:
+            raise ValueError(
+                f"Output shape {tuple(out.shape)} does not match the input shape {img.shape}"
+            )
+        else:
+            result = out
+        if workers is None:
+            workers = min(8, os.cpu_count() or 1)
+        workers = max(1, min(workers, n_frames))
+
+        if workers == 1:
+            for i in range(n_frames):
+                result[i] = filter_frame(img[i], filter_type, kwargs)
+                if progress_callback is not None:
+                    progress_callback(i + 1, n_frames)
+
+        else:
+            # FFTs release the GIL, so threads already run the frames in parallel.
+            # Frequency-domain kernels are cached in filters and shared by the frames.
+            if pool == "process":
+                # Forking a process that already runs numba/OpenMP threads is unsafe
+                executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+
+            # Only keep a few frames in flight so finished frames are written out
+            # and released instead of piling up in memory
+            max_pending = 2 * workers
+            pending = {}
+            next_frame = 0
+            n_done = 0
+            with executor:
+                while n_done < n_frames:
+                    while next_frame < n_frames and len(pending) < max_pending:
+                        future = executor.submit(
+                            filter_frame, img[next_frame], filter_type, kwargs
+                        )
+                        pending[future] = next_frame
+                        next_frame += 1
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result[pending.pop(future)] = future.result()
+                        n_done += 1
+                        if progress_callback is not None:
+                            progress_callback(n_done, n_frames)
+
+        if out is not None and hasattr(out, "flush"):
+            out.flush()
         return result
     else:
         raise ValueError("Unsupported image dimensions")
 
 
-def apply_filter_on_img_dict(img_dict, *args, **kwargs):
+# Top-level function so it can be sent to a process pool
+def filter_frame(img, filter_type, kwargs):
+    """Apply a filter on a single 2D frame
+    img: 2D numpy array
+    filter_type: 'Wiener', 'ABS', 'NL', 'BW', 'Gaussian'
+    kwargs: dict of parameters for the filter
+    """
+    filter_dict = {
+        "Wiener": filters.wiener_filter,
+        "ABS": filters.abs_filter,
+        "NL": filters.nlfilter,
+        "BW": filters.bw_lowpass,
+        "Gaussian": filters.gaussian_lowpass,
+    }
+    if filter_type in filter_dict.keys():
+        result = filter_dict[filter_type](img, **kwargs)
+        if filter_type in ["Wiener", "ABS", "NL"]:
+            return result[0]
+        elif filter_type in ["BW", "Gaussian"]:
+            return result
+
+
+def apply_filter_on_img_dict(img_dict, *args, out_file=None, **kwargs):
     # Take a image dictionary, apply the filter onto the data, and return the modified dictionary
+    # out_file: optional .npy path; for image stacks the filtered frames are streamed
+    # into a memory-mapped array in this file instead of being kept in RAM
     data = img_dict["data"]
+    if out_file is not None and data.ndim == 3:
+        kwargs["out"] = np.lib.format.open_memmap(
+            out_file, mode="w+", dtype=np.float32, shape=data.shape
+        )
     filtered_data = apply_filter(data, *args, **kwargs)
-    filtered_dict = copy.deepcopy(img_dict)
+    # Don't deepcopy the input data, it is replaced anyway
+    filtered_dict = copy.deepcopy({k: v for k, v in img_dict.items() if k != "data"})
     filtered_dict["data"] = filtered_data
     return filtered_dict
 
 
+def save_npy(file_path, data):
+    # Save an array as .npy through a temporary file renamed into place.
+    # npy files are opened memory-mapped, so the data may still be mapped from
+    # file_path itself. np.save would truncate the file under the mapping.
+    if not file_path.endswith(".npy"):
+        file_path += ".npy"  # Same naming as np.save
+    tmp = f"{file_path}.tmp{os.getpid()}"
+    try:
+        with open(tmp, "wb") as fp:
+            np.save(fp, data)
+        os.replace(tmp, file_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 def save_as_tif16(
     input_file,
     f_name,
@@ -444,9 +552,22 @@ def save_file_as(input_file, f_name, output_dir, f_type, **kwargs):
         )
 
 
-def load_file(file, file_type):
+def load_file(file, file_type, cache_dir=None, workers=None, progress_callback=None):
     # file: full path of the file
     # file_type: selected file type from the dialog
+    # cache_dir: optional folder to cache the decoded files in. Files opened again
+    # unchanged (same path, size, modification time and type) are memory mapped
+    # from the cache instead of decoded.
+    # workers, progress_callback: threads and progress for image series,
+    # see load_image_series
+    if cache_dir is not None and file_type in CACHED_FILE_TYPES:
+        f = load_cached_file(file, file_type, cache_dir)
+        if f is None:
+            f = load_file(file, file_type)
+            if f:
+                save_cached_file(f, file, file_type, cache_dir)
+        return f
+
     # Load emd file:
     if file_type == "Velox emd Files (*.emd)":
         f = emd_reader(file, select_type="images")
@@ -529,7 +650,9 @@ def load_file(file, file_type):
 
     # NPY
     elif file_type == "Numpy Array Files (*.npy)":
-        data = np.load(file)
+        # Map the file instead of reading it. Copy-on-write, so in-place edits
+        # from the filters stay in memory and never reach the file on disk.
+        data = np.load(file, mmap_mode="c")
         if data.ndim != 2 and data.ndim != 3:
             print(
                 "Unsupported data dimensions in NPY file! Only 2D or 3D arrays are supported."
@@ -610,43 +733,15 @@ def load_file(file, file_type):
         else:
             return
 
-        stack_img = []
-        for img_file in reordered_file:
-            try:
-                img = load_file(img_file, file_type)
-                stack_img.append(img[0])
-            except Exception as e:
-                print(f"Error loading {img_file}: {e} Skipped.")
-
-        stack_dict = stack_img[0]
-        img_size = stack_dict["data"].shape
-        if len(img_size) != 2:
-            print("Invalid image size! Images must be 2-dimensional!")
+        stack_dict = load_image_series(
+            reordered_file,
+            file_type,
+            cache_dir=cache_dir,
+            workers=workers,
+            progress_callback=progress_callback,
+        )
+        if stack_dict is None:
             return
-        stack_array = []
-        for img_dict in stack_img:
-            if img_dict["data"].shape == img_size:
-                stack_array.append(img_dict["data"])
-            else:
-                print(
-                    f"{img_dict['metadata']['General']['original_filename']} has been skipped due to invalid image size!"
-                )
-        stack = np.stack(stack_array)
-
-        stack_dict["data"] = stack
-        # reformat the axes
-        z_axis = {
-            "size": stack_dict["data"].shape[0],
-            "index_in_array": 0,
-            "name": "z",
-            "scale": 1,
-            "offset": 0.0,
-            "units": None,
-            "navigate": True,
-        }
-        stack_dict["axes"].insert(0, z_axis)
-        stack_dict["axes"][1]["index_in_array"] = 1
-        stack_dict["axes"][2]["index_in_array"] = 2
         f = [stack_dict]
 
     # Validate the content of f
@@ -678,9 +773,216 @@ def load_file(file, file_type):
     return f_valid
 
 
-def load_4dstem(file, file_type, lazy=False):
+def load_image_series(
+    file_list, file_type, cache_dir=None, workers=None, progress_callback=None
+):
+    """
+    Load a list of 2D image files into one image stack
+    file_list: files in the order of the stack
+    file_type: file type of all the files for load_file
+    cache_dir: optional cache folder for load_file
+    workers: number of threads to decode the files concurrently.
+        None uses up to 8 CPU cores
+    progress_callback: function called as progress_callback(n_done, n_total)
+        each time a file is loaded. None prints the progress every 10%.
+    Return: img dict of the stack, or None if no valid image is found.
+    The first valid file gives the metadata and the image size, files of other
+    sizes are skipped. The stack has the common dtype of all frames, as with np.stack.
+    """
+
+    def load_one(img_file):
+        try:
+            return load_file(img_file, file_type, cache_dir=cache_dir)[0]
+        except Exception as e:
+            print(f"Error loading {img_file}: {e} Skipped.")
+
+    # The first loadable file sets the size of the stack
+    stack_dict = None
+    for first, img_file in enumerate(file_list):
+        stack_dict = load_one(img_file)
+        if stack_dict is not None:
+            break
+    if stack_dict is None:
+        print("No valid image found in the series!")
+        return
+    img_size = stack_dict["data"].shape
+    if len(img_size) != 2:
+        print("Invalid image size! Images must be 2-dimensional!")
+        return
+
+    n_total = len(file_list)
+    stack = np.empty((n_total - first,) + img_size, dtype=stack_dict["data"].dtype)
+    stack[0] = stack_dict["data"]
+    valid = np.zeros(len(stack), dtype=bool)
+    valid[0] = True
+    n_done = first + 1
+    # Guards the stack while a frame of a wider dtype reallocates it
+    stack_lock = threading.Lock()
+
+    def report():
+        if progress_callback is not None:
+            progress_callback(n_done, n_total)
+        elif n_done == n_total or n_done % max(n_total // 10, 1) == 0:
+            print(f"Loaded {n_done}/{n_total} files.")
+
+    report()
+
+    def decode(i):
+        # Each thread writes its frame straight into the stack
+        nonlocal stack
+        img_dict = load_one(file_list[first + i])
+        if img_dict is None:
+            return
+        if img_dict["data"].shape == img_size:
+            data = img_dict["data"]
+            with stack_lock:
+                if not np.can_cast(data.dtype, stack.dtype):
+                    # Promote instead of truncating, e.g. uint16 or float frames in a uint8 stack
+                    stack = stack.astype(np.result_type(stack.dtype, data.dtype))
+                stack[i] = data
+            valid[i] = True
+        else:
+            print(
+                f"{img_dict['metadata']['General']['original_filename']} has been skipped due to invalid image size!"
+            )
+
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(decode, i) for i in range(1, len(stack))]
+        for future in futures:
+            future.result()
+            n_done += 1
+            report()
+
+    if not valid.all():
+        # Move the valid frames to the front in place, no second copy of the stack
+        idx = np.flatnonzero(valid)
+        for j, i in enumerate(idx):
+            if j != i:
+                stack[j] = stack[i]
+        stack = stack[: len(idx)]
+
+    stack_dict["data"] = stack
+    # reformat the axes
+    z_axis = {
+        "size": stack_dict["data"].shape[0],
+        "index_in_array": 0,
+        "name": "z",
+        "scale": 1,
+        "offset": 0.0,
+        "units": None,
+        "navigate": True,
+    }
+    stack_dict["axes"].insert(0, z_axis)
+    stack_dict["axes"][1]["index_in_array"] = 1
+    stack_dict["axes"][2]["index_in_array"] = 2
+    return stack_dict
+
+
+# ==================== Cache of decoded files for load_file ====================
+# Formats that are decoded by rsciio and slow to read again. npy and pkl are
+# already raw, image series are cached per file.
+CACHED_FILE_TYPES = [
+    "Velox emd Files (*.emd)",
+    "DigitalMicrograph Files (*.dm3 *.dm4)",
+    "TIA ser Files (*.ser)",
+    "Tiff Files (*.tif *.tiff)",
+    "MRC Files (*.mrc)",
+    "Image Formats (*.tif *.tiff *.jpg *.jpeg *.png *.bmp)",
+    "USID (*.h5 *.hdf5)",
+]
+# Part of the cache key, bump it when the layout of the cache entries changes
+CACHE_VERSION = 2
+
+
+def get_cache_key(file, file_type):
+    # The cache entry is addressed by the file identity, a changed file gets a new key
+    stat = os.stat(file)
+    identity = [
+        os.path.abspath(file),
+        stat.st_size,
+        stat.st_mtime_ns,
+        file_type,
+        CACHE_VERSION,
+    ]
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+
+def load_cached_file(file, file_type, cache_dir):
+    """
+    Load a file decoded by load_file from the cache
+    Returns: list of img dicts with memory-mapped (copy-on-write) data,
+    or None if the file is not cached
+    """
+    entry = os.path.join(cache_dir, get_cache_key(file, file_type))
+    meta_file = os.path.join(entry, "meta.pkl")
+    if not os.path.isfile(meta_file):
+        return None
+    try:
+        with open(meta_file, "rb") as fp:
+            f = pickle.load(fp)
+        for i, img_dict in enumerate(f):
+            # Copy-on-write, so that the data can be modified in memory as usual
+            img_dict["data"] = np.load(os.path.join(entry, f"{i}.npy"), mmap_mode="c")
+    except Exception as e:
+        print(f"Error loading cached file for {file}: {e}. Loading the original file.")
+        return None
+    return f
+
+
+def save_cached_file(f, file, file_type, cache_dir):
+    # Save the decoded data as .npy and the rest of the img dicts with pickle,
+    # which keeps the metadata types (tuples, enums, numpy values) as they were decoded
+    entry = os.path.join(cache_dir, get_cache_key(file, file_type))
+    tmp = entry + f".tmp{os.getpid()}"
+    try:
+        os.makedirs(tmp, exist_ok=True)
+        meta = []
+        for i, img_dict in enumerate(f):
+            data = np.asarray(img_dict["data"])
+            if data.dtype.hasobject:
+                raise TypeError(f"cannot cache data of type {data.dtype}")
+            np.save(os.path.join(tmp, f"{i}.npy"), data)
+            meta.append({key: val for key, val in img_dict.items() if key != "data"})
+        with open(os.path.join(tmp, "meta.pkl"), "wb") as fp:
+            pickle.dump(meta, fp)
+        # Only complete entries appear under the key
+        os.replace(tmp, entry)
+    except Exception as e:
+        print(f"Could not cache {file}: {e}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def copy_on_write(data):
+    # Make a read-only memory-mapped array (or a view of one) writable by
+    # remapping its file copy-on-write. Edits stay private to this process and
+    # only the touched pages get copied. Other arrays are returned as is.
+    # data: numpy array, e.g. the 4D dataset from load_4dstem
+    if data.flags.writeable or not isinstance(data, np.memmap):
+        return data
+    root = data
+    while isinstance(root.base, np.memmap):
+        root = root.base
+    cow = np.memmap(
+        root.filename,
+        dtype=np.uint8,
+        mode="c",
+        offset=root.offset,
+        shape=(root.nbytes,),
+    )
+    # Keep the view (crop, flip) by pointing at the same bytes with the same strides
+    start = data.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+    return np.ndarray(
+        data.shape, dtype=data.dtype, buffer=cow, offset=start, strides=data.strides
+    )
+
+
+def load_4dstem(file, file_type, lazy=False, mmap_mode="r"):
     # Placeholder function for loading 4D-STEM data
     # The actual implementation will depend on the specific format of the 4D-STEM data and may require additional libraries
+    # mmap_mode: np.load mode for npy files, None reads the whole file into memory
     print(f"Loading 4D-STEM data from {file} with type {file_type}...")
     # EMPAD file
     if file_type == "EMPAD Files (*.xml)":
@@ -706,12 +1008,18 @@ def load_4dstem(file, file_type, lazy=False):
         else:
             print("No valid 4D dataset found in this file!")
             return
+        if f is None:
+            return
+        # Only the selected dataset is read
+        f = load_py4dstem_data(file, f, lazy=lazy)
 
     elif file_type == "DigitalMicrograph Files (*.dm3 *.dm4)":
         f = dm_reader(file)[0]
 
     elif file_type == "Numpy Array Files (*.npy)":
-        data = np.load(file)
+        # Memory map the array so only the frames that are displayed get read.
+        # Read-only by default, see copy_on_write for in-place edits.
+        data = np.load(file, mmap_mode=mmap_mode)
         if data.ndim != 4:
             raise ValueError(
                 "Invalid 4D-STEM data! The numpy array must be 4-dimensional."
@@ -783,6 +1091,9 @@ def load_4dstem(file, file_type, lazy=False):
             # ['original_metadata'] is optional
         except Exception:
             pass
+        if "file_handle" in f:
+            # Open file of a lazy dataset, closed by PlotCanvas4D
+            f_valid["file_handle"] = f["file_handle"]
         for axis in f_valid["axes"]:
             if "navigate" not in axis.keys():
                 # Need this navigate key to write some formats
@@ -806,9 +1117,15 @@ def load_py4dstem(file_path):
       <unknown_root>/datacube/dim0, dim1, dim2, dim3
       <unknown_root>/metadatabundle/calibration (optional)
 
-    Returns:
+    Only the shape, dtype and calibration of each 4D dataset are read, so the
+    user can pick one before anything big is loaded. Read the data of the
+    selected one with load_py4dstem_data.
+
+    Returns a list of:
       {
-        "data": np.ndarray,
+        "group": str,  # HDF5 path of the datacube group
+        "shape": tuple,
+        "dtype": np.dtype,
         "metadata": dict,
         "axes": list[dict]
       }
@@ -895,10 +1212,6 @@ def load_py4dstem(file_path):
             "Q_pixel_units": None,
         }
 
-    def get_4D_data(group):
-        data = to_python(group["data"][()])
-        return data
-
     with h5py.File(file_path, "r") as f:
         file_name = os.path.basename(file_path)
         root = find_root_group(f)
@@ -912,7 +1225,7 @@ def load_py4dstem(file_path):
         if data_groups:
             for group in data_groups:
                 try:
-                    data = get_4D_data(group)
+                    data = group["data"]
                     axis_names = ["scan_y", "scan_x", "height", "width"]
                     axis_scales = [r_scale, r_scale, q_scale, q_scale]
                     axis_units = [r_units, r_units, q_units, q_units]
@@ -938,7 +1251,9 @@ def load_py4dstem(file_path):
                     }
 
                     data_dict = {
-                        "data": data,
+                        "group": group.name,
+                        "shape": data.shape,
+                        "dtype": data.dtype,
                         "metadata": metadata,
                         "axes": axes,
                         "original_metadata": {},
@@ -952,6 +1267,40 @@ def load_py4dstem(file_path):
         return data_dictionaries
 
 
+def load_py4dstem_data(file_path, dataset, lazy=False):
+    """
+    Read the 4D data of one dataset returned by load_py4dstem.
+
+    file_path: the py4DSTEM HDF5 file
+    dataset: one of the dictionaries returned by load_py4dstem
+    lazy: if True, keep the data in the file as a dask array. Its chunks are
+      multiples of the HDF5 chunks along the scan axes and span whole
+      diffraction patterns, so every read (e.g. a virtual detector) is chunk aligned.
+
+    Returns the usual {"data", "metadata", "axes", "original_metadata"} dictionary.
+    A lazy dictionary also holds the open h5py.File as "file_handle", to be
+    closed once the data is no longer used (PlotCanvas4D does it with its windows).
+    """
+    f = {
+        key: value
+        for key, value in dataset.items()
+        if key not in ("group", "shape", "dtype")
+    }
+    if lazy:
+        import dask.array as da
+
+        # The file has to stay open for as long as the dask array is in use
+        h5 = h5py.File(file_path, "r")
+        f["data"] = da.from_array(
+            h5[dataset["group"]]["data"], chunks=("auto", "auto", -1, -1)
+        )
+        f["file_handle"] = h5
+    else:
+        with h5py.File(file_path, "r") as h5:
+            f["data"] = h5[dataset["group"]]["data"][()]
+    return f
+
+
 class Select4DDatasetDialog(QDialog):
     def __init__(self, datasets, parent=None):
         super().__init__(parent)
@@ -976,6 +1325,11 @@ class Select4DDatasetDialog(QDialog):
             if not title:
                 title = f"Dataset {idx}"
 
+            # Descriptors from load_py4dstem carry shape and dtype, show them to help choose
+            if "shape" in dataset:
+                shape = " x ".join(str(n) for n in dataset["shape"])
+                title = f"{title} ({shape}, {dataset['dtype']})"
+
             self.listWidget.addItem(QListWidgetItem(title))
 
         if self.listWidget.count() > 0:
@@ -240,6 +240,8 @@ class UI_TemCompanion(QMainWindow):
             "default_batch_open", "Velox emd Files (*.emd)"
         )
         default_save_filter = config.pop("default_save", "16-bit TIFF Files (*.tiff)")
+        # Optional folder to cache decoded files, None to disable
+        self.load_cache_dir = config.pop("load_cache_dir", None)
 
         self.settings = {
             "lastOpenFilter": default_open_filter,
@@ -735,7 +737,7 @@ border: 2px solid #FF8C00;
     # ====================== Open file for preview ===============================
     def preview(self):
         try:
-            f = load_file(self.file, self.file_type)
+            f = load_file(self.file, self.file_type, cache_dir=self.load_cache_dir)
             if f is None:
                 return
             f_name = getFileNameType(self.file)[0]
@@ -7,14 +7,111 @@ import pyqtgraph as pg
 import numpy as np
 import os
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 from rsciio.usid import file_writer as usid_writer
 
 from .canvas import PlotCanvas, Worker
 from .GPA import create_mask
 from .DPC import reconstruct_iDPC, reconstruct_dDPC
-from .functions import getDirectory, getFileNameType, save_as_tif16, save_with_pil
+from .functions import (
+    getDirectory,
+    getFileNameType,
+    save_as_tif16,
+    save_with_pil,
+    save_npy,
+    copy_on_write,
+)
 from .UI_elements import RemoveNaNDialog
 
+# Bytes of 4D data the virtual detector engine holds in memory at once
+VIRTUAL_DETECTOR_MEMORY = 512 * 1024**2
+# Masks covering less than this fraction of the detector gather their pixels instead
+# of weighting all of them. Gathering is faster up to a few percent fill.
+SPARSE_MASK_FRACTION = 0.05
+
+
+def scan_row_blocks(data, memory_limit=VIRTUAL_DETECTOR_MEMORY, workers=1):
+    # Split the scan rows of a 4D dataset into (start, end) blocks so that one
+    # block per worker fits in memory_limit. For chunked datasets (dask, h5py)
+    # the blocks are whole multiples of the chunk rows, so every read is chunk aligned.
+    n_rows = data.shape[0]
+    row_bytes = int(np.prod(data.shape[1:])) * np.dtype(data.dtype).itemsize
+    rows = max(1, memory_limit // max(workers, 1) // max(row_bytes, 1))
+    chunks = getattr(data, "chunks", None)
+    if chunks:
+        # dask gives the chunk sizes along each axis, h5py one chunk shape
+        chunk_rows = chunks[0][0] if isinstance(chunks[0], tuple) else chunks[0]
+        rows = max(chunk_rows, rows // chunk_rows * chunk_rows)
+    return [(start, min(start + rows, n_rows)) for start in range(0, n_rows, rows)]
+
+
+def read_scan_rows(data, start, end):
+    # Read scan rows start:end of a 4D dataset into a numpy array
+    block = data[start:end]
+    if hasattr(block, "compute"):
+        # The engine already runs the blocks in parallel, compute each one in place
+        block = block.compute(scheduler="synchronous")
+    return np.asarray(block)
+
+
+def virtual_images(data, masks, workers=None, memory_limit=VIRTUAL_DETECTOR_MEMORY):
+    # Virtual detector engine: sum(data[y, x] * mask) for every scan position.
+    # The scan rows are streamed block by block over a thread pool, so numpy arrays,
+    # memory maps and lazy (dask or h5py) datasets never need the full datacube in memory.
+    # data: 4D array (scan_y, scan_x, qy, qx)
+    # masks: one (qy, qx) mask, or a stack of n masks (n, qy, qx) computed in one pass
+    # workers: number of threads, defaults to the CPU count
+    # memory_limit: bytes of 4D data in memory at once
+    # Returns a (scan_y, scan_x) image, or (n, scan_y, scan_x) for a stack of masks
+    masks = np.asarray(masks)
+    single = masks.ndim == 2
+    scan_y, scan_x, qy, qx = data.shape
+    dtype = np.result_type(data.dtype, masks.dtype)
+    weights = masks.reshape(-1, qy * qx).T.astype(dtype)  # (qy * qx, n)
+    out = np.empty((weights.shape[1], scan_y, scan_x), dtype=dtype)
+
+    # Small apertures (e.g. a BF disk) touch few detector pixels, only gather and sum those.
+    support = np.flatnonzero(np.any(weights != 0, axis=1))
+    nan_check = None
+    if len(support) < SPARSE_MASK_FRACTION * qy * qx:
+        weights = weights[support]
+        if np.issubdtype(data.dtype, np.inexact):
+            # A NaN anywhere in a pattern makes its dense sum NaN (NaN * 0), and
+            # remove_nan relies on that. Keep it in the sparse path with a cheap
+            # unweighted sum of each pattern.
+            nan_check = np.ones(qy * qx, dtype=data.dtype)
+    else:
+        support = None
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # Integer data is converted to the output type block by block, leave room for it
+    itemsize = np.dtype(data.dtype).itemsize
+    converted = dtype.itemsize if dtype != data.dtype else 0
+    budget = memory_limit * itemsize // (itemsize + converted)
+    blocks = scan_row_blocks(data, budget, workers)
+    workers = min(workers, len(blocks))
+
+    def contract(block):
+        start, end = block
+        rows = read_scan_rows(data, start, end).reshape(-1, qy * qx)
+        if support is None:
+            result = rows @ weights
+        else:
+            result = np.take(rows, support, axis=1) @ weights
+            if nan_check is not None:
+                result[np.isnan(rows @ nan_check)] = np.nan
+        out[:, start:end] = result.T.reshape(-1, end - start, scan_x)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(contract, blocks))
+    else:
+        for block in blocks:
+            contract(block)
+
+    return out[0] if single else out
+
 
 class DiffractionCanvas(PlotCanvas):
     def __init__(self, img4d, master_handle, parent=None):
@@ -48,6 +145,7 @@ class DiffractionCanvas(PlotCanvas):
                 R_canvas_name
             ].close()  # Close the virtual image canvas if it's still open
             self.parent().preview_dict.pop(R_canvas_name, None)
+        self.master_handle.close_file()
         self.master_handle = None  # Remove reference to master handle to allow garbage collection of the virtual image canvas if it's still open
 
     def create_menubar(self):
@@ -321,7 +419,7 @@ class DiffractionCanvas(PlotCanvas):
             print(f"Save figure to {self.file_path} with format {self.file_type}")
             img_to_save = {}
             if self.selected_type == "Numpy Array Files (*.npy)":
-                np.save(self.file_path, self.img4d["data"])
+                save_npy(self.file_path, self.img4d["data"])
             elif self.selected_type == "Pickle Dictionary Files (*.pkl)":
                 img_dict = self.img4d
                 for key in ["data", "axes", "metadata", "original_metadata"]:
@@ -515,6 +613,7 @@ class VirtualImageCanvas(PlotCanvas):
                 Q_canvas_name
             ].close()  # Close the diffraction canvas if it's still open
             self.parent().preview_dict.pop(Q_canvas_name, None)
+        self.master_handle.close_file()
         self.master_handle = None  # Remove reference to master handle to allow garbage collection of the diffraction canvas if it's still open
 
     def create_menubar(self):
@@ -754,7 +853,7 @@ class VirtualImageCanvas(PlotCanvas):
             print(f"Save figure to {self.file_path} with format {self.file_type}")
             img_to_save = {}
             if self.selected_type == "Numpy Array Files (*.npy)":
-                np.save(self.file_path, self.img4d["data"])
+                save_npy(self.file_path, self.img4d["data"])
             elif self.selected_type == "Pickle Dictionary Files (*.pkl)":
                 img_dict = self.img4d
                 for key in ["data", "axes", "metadata", "original_metadata"]:
@@ -906,6 +1005,12 @@ class PlotCanvas4D:
         self.Q_canvas.show()
         self.Q_canvas.position_window("center right")
 
+    def close_file(self):
+        # Lazy datasets (load_py4dstem_data) keep their file open, close it with the windows
+        h5 = self.img4d.pop("file_handle", None)
+        if h5 is not None:
+            h5.close()
+
     def remove_nan(self):
         # Remove NaN values from the 4D image data and update both canvases
         dialog = RemoveNaNDialog(self.R_canvas)
@@ -915,6 +1020,9 @@ class PlotCanvas4D:
             virtual_img = self.R_canvas.canvas.current_img
             nan_mask = np.isnan(virtual_img)
             nan_indices = np.argwhere(nan_mask)
+            if len(nan_indices):
+                # Memory-mapped data is read-only, patch it copy-on-write
+                self.img_data = copy_on_write(self.img_data)
             for idx in nan_indices:
                 y, x = idx
                 if method == "zero":
@@ -1201,10 +1309,8 @@ class PlotCanvas4D:
 
     def get_virtual_image_with_mask(self, mask):
         # This method can be called to get the virtual image based on a custom mask
-        # Use contraction to avoid allocating a full 4D temporary (img_data * mask).
-        mask = np.asarray(mask)
-        virtualimg = np.tensordot(self.img_data, mask, axes=([2, 3], [0, 1]))
-        return virtualimg
+        # Streamed by scan rows, see virtual_images
+        return virtual_images(self.img_data, mask)
 
     def get_annular_mask(self, size, center, inner_radius, outer_radius):
         mask = np.zeros(size)
@@ -1311,12 +1417,12 @@ class PlotCanvas4D:
                 np.float64, copy=False
             )
 
-        # Vectorized weighted reductions without allocating a 4D masked copy.
+        # Mass and the two first moments as three virtual detectors, in one pass over the data
         yy = np.arange(Q_size[0], dtype=np.float64)[:, None]  # axis=2
         xx = np.arange(Q_size[1], dtype=np.float64)[None, :]  # axis=3
-        mass = np.tensordot(data, mask, axes=([2, 3], [0, 1]))
-        com_y_num = np.tensordot(data, mask * yy, axes=([2, 3], [0, 1]))
-        com_x_num = np.tensordot(data, mask * xx, axes=([2, 3], [0, 1]))
+        mass, com_y_num, com_x_num = virtual_images(
+            data, np.stack([mask, mask * yy, mask * xx])
+        )
 
         # Avoid divide-by-zero
         eps = 1e-12